@@ -0,0 +1,410 @@
+"""Benchmark and load-test suite for the recognition pipeline.
+
+Runs process_image in-process and/or the HTTP endpoints of a running server
+over a local image corpus (backend/uploads by default) and writes a JSON
+report so runs can be compared for regressions.
+
+Usage:
+    python -m backend.benchmark pipeline --repeat 3 --out bench.json
+    python -m backend.benchmark http --url http://localhost:8000 --concurrency 1,4,8
+    python -m backend.benchmark coldstart --roles api,inference --repeat 5
+    python -m backend.benchmark compare baseline.json bench.json --threshold 0.10
+
+coldstart starts a fresh interpreter per run and reports import time, time
+until ready and peak RSS for each process role (see COLDSTART_ROLES). http
+samples the server's RSS from /metrics while each concurrency level runs.
+compare flags latency or memory growth and throughput or accuracy drops.
+
+Plate accuracy is reported when --labels points to a JSON file mapping image
+file names to the expected plate, e.g. {"car1.jpg": "12가3456"}.
+"""
+import argparse
+import json
+import math
+import os
+import platform
+import resource
+import sys
+import threading
+import time
+import urllib.request
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_CORPUS = os.path.join(BASE_DIR, "uploads")
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png")
+
+def load_corpus(corpus_dir):
+    """Return [(file name, bytes)] for every full-size image in corpus_dir."""
+    images = []
+    for name in sorted(os.listdir(corpus_dir)):
+        # Skip thumbnails generated by /api/upload
+        if name.startswith("thumb_") or not name.lower().endswith(IMAGE_EXTENSIONS):
+            continue
+        with open(os.path.join(corpus_dir, name), "rb") as f:
+            images.append((name, f.read()))
+    return images
+
+def load_labels(path):
+    if not path:
+        return {}
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+def percentile(values, pct):
+    """Nearest-rank percentile of values (pct in 0-100)."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, math.ceil(pct / 100.0 * len(ordered)) - 1))
+    return ordered[rank]
+
+def summarize(latencies, wall_seconds):
+    return {
+        "count": len(latencies),
+        "p50_ms": _ms(percentile(latencies, 50)),
+        "p95_ms": _ms(percentile(latencies, 95)),
+        "p99_ms": _ms(percentile(latencies, 99)),
+        "mean_ms": _ms(sum(latencies) / len(latencies)) if latencies else None,
+        "throughput_rps": round(len(latencies) / wall_seconds, 3) if wall_seconds > 0 else None,
+    }
+
+def peak_rss_mb():
+    # ru_maxrss is KiB on Linux, bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        peak /= 1024
+    return round(peak / 1024, 1)
+
+def _ms(seconds):
+    return round(seconds * 1000, 2) if seconds is not None else None
+
+def accuracy(predictions, labels):
+    """Share of labelled images whose best reading equals the expected plate."""
+    labelled = [name for name in predictions if name in labels]
+    if not labelled:
+        return None
+    correct = sum(1 for name in labelled if predictions[name] == labels[name])
+    return {"labelled": len(labelled), "correct": correct, "accuracy": round(correct / len(labelled), 4)}
+
+# --- In-process pipeline ---
+
+def bench_pipeline(images, labels, repeat, warmup):
+    try:
+        from backend.inference import process_image
+    except ImportError:
+        from inference import process_image
+
+    # First call loads the models; keep it out of the latency numbers
+    load_start = time.perf_counter()
+    for _, data in images[:warmup]:
+        process_image(data)
+    warmup_seconds = time.perf_counter() - load_start
+
+    latencies = []
+    predictions = {}
+    wall_start = time.perf_counter()
+    for _ in range(repeat):
+        for name, data in images:
+            start = time.perf_counter()
+            results = process_image(data)
+            latencies.append(time.perf_counter() - start)
+            predictions[name] = results[0]["text"] if results else None
+    wall = time.perf_counter() - wall_start
+
+    report = summarize(latencies, wall)
+    report["warmup_seconds"] = round(warmup_seconds, 3)
+    report["peak_rss_mb"] = peak_rss_mb()
+    report["accuracy"] = accuracy(predictions, labels)
+    report["predictions"] = predictions
+    return report
+
+# --- HTTP load test ---
+
+def _multipart(name, data):
+    boundary = uuid.uuid4().hex
+    body = (
+        f"--{boundary}\r\n"
+        f'Content-Disposition: form-data; name="file"; filename="{name}"\r\n'
+        "Content-Type: image/jpeg\r\n\r\n"
+    ).encode() + data + f"\r\n--{boundary}--\r\n".encode()
+    return body, f"multipart/form-data; boundary={boundary}"
+
+def _request(url, body=None, content_type=None, timeout=120):
+    req = urllib.request.Request(url, data=body, method="POST" if body is not None else "GET")
+    if content_type:
+        req.add_header("Content-Type", content_type)
+    start = time.perf_counter()
+    with urllib.request.urlopen(req, timeout=timeout) as resp:
+        payload = resp.read()
+    return time.perf_counter() - start, payload
+
+def _load(jobs, concurrency):
+    """Run jobs (callables returning (latency, payload)) with N concurrent clients."""
+    latencies, errors, payloads = [], 0, []
+    wall_start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        futures = [pool.submit(job) for job in jobs]
+        for future in futures:
+            try:
+                latency, payload = future.result()
+                latencies.append(latency)
+                payloads.append(payload)
+            except Exception:
+                errors += 1
+                payloads.append(None)
+    wall = time.perf_counter() - wall_start
+    report = summarize(latencies, wall)
+    report["errors"] = errors
+    return report, payloads
+
+RSS_METRIC = "process_resident_memory_bytes"
+RSS_SAMPLE_INTERVAL = 0.25
+
+def server_rss_mb(metrics_urls):
+    """Summed resident memory of the servers, scraped from their /metrics; None if unavailable."""
+    total = 0.0
+    for url in metrics_urls:
+        try:
+            _, payload = _request(url, timeout=10)
+        except Exception:
+            return None
+        for line in payload.decode("utf-8", "replace").splitlines():
+            if line.startswith(RSS_METRIC + " "):
+                total += float(line.split()[1])
+                break
+        else:
+            return None
+    return round(total / (1024 * 1024), 1)
+
+class RssSampler:
+    """Poll server RSS in the background while a load level runs, keeping the peak."""
+
+    def __init__(self, metrics_urls):
+        self.metrics_urls = metrics_urls
+        self.peak = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _sample(self):
+        rss = server_rss_mb(self.metrics_urls)
+        if rss is not None and (self.peak is None or rss > self.peak):
+            self.peak = rss
+        return rss
+
+    def _run(self):
+        while not self._stop.wait(RSS_SAMPLE_INTERVAL):
+            self._sample()
+
+    def __enter__(self):
+        self.before = self._sample()
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.after = self._sample()
+
+def bench_http(base_url, images, labels, concurrency_levels, requests, metrics_urls=None):
+    base_url = base_url.rstrip("/")
+    # With a separate inference service, pass both servers' /metrics
+    metrics_urls = metrics_urls or [f"{base_url}/metrics"]
+    report = {}
+    for concurrency in concurrency_levels:
+        level = {}
+
+        with RssSampler(metrics_urls) as rss:
+            picks = [images[i % len(images)] for i in range(requests)] if images else []
+            jobs = []
+            for name, data in picks:
+                body, content_type = _multipart(name, data)
+                jobs.append(lambda b=body, c=content_type: _request(f"{base_url}/analyze", b, c))
+            analyze, payloads = _load(jobs, concurrency)
+            predictions = {}
+            for (name, _), payload in zip(picks, payloads):
+                if payload is not None:
+                    predictions[name] = json.loads(payload).get("text")
+            analyze["accuracy"] = accuracy(predictions, labels)
+            level["analyze"] = analyze
+
+            for path in ("/api/vehicles", "/api/history"):
+                jobs = [lambda p=path: _request(f"{base_url}{p}") for _ in range(requests)]
+                level[path], _ = _load(jobs, concurrency)
+
+        # Server-side memory, from process_resident_memory_bytes
+        level["rss_before_mb"] = rss.before
+        level["rss_after_mb"] = rss.after
+        level["peak_rss_mb"] = rss.peak
+        report[str(concurrency)] = level
+    return report
+
+# --- Cold start per process role ---
+
+# role -> (module imported, statement run once it is imported)
+COLDSTART_ROLES = {
+    "api": ("backend.main", ""),                                     # CRUD + static, no ML stack
+    "combined": ("backend.main", "module.load_inference()"),         # single process after its first /analyze
+    "inference": ("backend.inference_service", ""),                  # inference service, models still lazy
+    "inference+models": ("backend.inference_service", "module.models.preload()"),
+}
+ML_MODULES = ("torch", "paddleocr", "cv2")
+
+COLDSTART_SCRIPT = """
+import importlib, json, resource, sys, time
+start = time.perf_counter()
+module = importlib.import_module({module!r})
+imported = time.perf_counter() - start
+{setup}
+ready = time.perf_counter() - start
+peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+print(json.dumps({{
+    "import_seconds": imported,
+    "ready_seconds": ready,
+    "peak_rss_kb": peak / 1024 if sys.platform == "darwin" else peak,
+    "modules": len(sys.modules),
+    "ml_loaded": [name for name in {ml!r} if name in sys.modules],
+}}))
+"""
+
+def bench_coldstart(roles, repeat):
+    """Start a fresh interpreter per run and time importing each role's app."""
+    import subprocess
+
+    project_dir = os.path.dirname(BASE_DIR)
+    report = {}
+    for role in roles:
+        module, setup = COLDSTART_ROLES[role]
+        script = COLDSTART_SCRIPT.format(module=module, setup=setup, ml=ML_MODULES)
+        runs, process_seconds = [], []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            proc = subprocess.run([sys.executable, "-c", script], cwd=project_dir,
+                                  capture_output=True, text=True)
+            elapsed = time.perf_counter() - start
+            if proc.returncode != 0:
+                report[role] = {"error": proc.stderr.strip().splitlines()[-1:]}
+                break
+            runs.append(json.loads(proc.stdout.strip().splitlines()[-1]))
+            process_seconds.append(elapsed)
+        else:
+            report[role] = {
+                "module": module,
+                "runs": repeat,
+                "import_p50_ms": _ms(percentile([r["import_seconds"] for r in runs], 50)),
+                "ready_p50_ms": _ms(percentile([r["ready_seconds"] for r in runs], 50)),
+                # Interpreter start to exit, as a process manager sees it
+                "process_p50_ms": _ms(percentile(process_seconds, 50)),
+                "peak_rss_mb": round(max(r["peak_rss_kb"] for r in runs) / 1024, 1),
+                "modules": runs[-1]["modules"],
+                "ml_loaded": runs[-1]["ml_loaded"],
+            }
+    return report
+
+# --- Regression comparison ---
+
+# metric key -> direction: +1 when growth is a regression, -1 when a drop is
+COMPARED_KEYS = {
+    "p50_ms": 1, "p95_ms": 1, "p99_ms": 1,
+    "import_p50_ms": 1, "ready_p50_ms": 1, "process_p50_ms": 1,
+    "peak_rss_mb": 1, "rss_after_mb": 1,
+    "throughput_rps": -1,
+    "accuracy": -1,
+}
+
+def _flatten(report, prefix=""):
+    for key, value in report.items():
+        path = f"{prefix}{key}"
+        if isinstance(value, dict):
+            yield from _flatten(value, path + ".")
+        elif key in COMPARED_KEYS and isinstance(value, (int, float)):
+            yield path, key, value
+
+def compare(baseline, current, threshold):
+    """Return [(metric, old, new, change)] for metrics that got worse by more than threshold.
+
+    Latency and memory regress when they grow, throughput and accuracy when they drop.
+    """
+    old = {path: value for path, _, value in _flatten(baseline.get("results", {}))}
+    regressions = []
+    for path, key, new in _flatten(current.get("results", {})):
+        if path in old and old[path] > 0:
+            change = (new - old[path]) / old[path]
+            if change * COMPARED_KEYS[key] > threshold:
+                regressions.append((path, old[path], new, change))
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the plate recognition pipeline")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    for name in ("pipeline", "http"):
+        p = sub.add_parser(name)
+        p.add_argument("--corpus", default=DEFAULT_CORPUS, help="Directory of sample images")
+        p.add_argument("--labels", help="JSON file mapping image name to expected plate")
+        p.add_argument("--out", help="Write the JSON report here (default: stdout)")
+    sub.choices["pipeline"].add_argument("--repeat", type=int, default=3)
+    sub.choices["pipeline"].add_argument("--warmup", type=int, default=1)
+    sub.choices["http"].add_argument("--url", default="http://localhost:8000")
+    sub.choices["http"].add_argument("--concurrency", default="1,4,8", help="Comma separated client counts")
+    sub.choices["http"].add_argument("--requests", type=int, default=20, help="Requests per endpoint and level")
+    sub.choices["http"].add_argument("--metrics-url", action="append",
+                                     help="/metrics URL to sample server RSS from, repeatable (default: <url>/metrics)")
+
+    p = sub.add_parser("coldstart")
+    p.add_argument("--roles", default=",".join(COLDSTART_ROLES), help="Comma separated process roles")
+    p.add_argument("--repeat", type=int, default=5)
+    p.add_argument("--out", help="Write the JSON report here (default: stdout)")
+
+    p = sub.add_parser("compare")
+    p.add_argument("baseline")
+    p.add_argument("current")
+    p.add_argument("--threshold", type=float, default=0.10, help="Allowed relative latency growth")
+
+    args = parser.parse_args(argv)
+
+    if args.command == "compare":
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        with open(args.current, encoding="utf-8") as f:
+            current = json.load(f)
+        regressions = compare(baseline, current, args.threshold)
+        for path, old, new, change in regressions:
+            print(f"REGRESSION {path}: {old} -> {new} ({change:+.1%})")
+        if not regressions:
+            print("No regressions")
+        return 1 if regressions else 0
+
+    if args.command == "coldstart":
+        results = bench_coldstart(args.roles.split(","), args.repeat)
+        corpus = None
+    else:
+        images = load_corpus(args.corpus)
+        labels = load_labels(args.labels)
+        if args.command == "pipeline":
+            results = bench_pipeline(images, labels, args.repeat, args.warmup)
+        else:
+            levels = [int(c) for c in args.concurrency.split(",")]
+            results = bench_http(args.url, images, labels, levels, args.requests, args.metrics_url)
+        corpus = {"path": args.corpus, "images": len(images)}
+
+    report = {
+        "command": args.command,
+        "timestamp": datetime.now().isoformat(),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "corpus": corpus,
+        "results": results,
+    }
+    output = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            f.write(output)
+    else:
+        print(output)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,103 @@
+"""Async read-through cache with TTL, LRU size bound and stale-while-revalidate.
+
+Entries younger than ttl are served directly. Older entries, up to
+ttl + stale_ttl, are served immediately while one background refresh runs,
+and are also used when the loader fails. invalidate() drops entries and
+discards any refresh that was started before it, so a slow read can never
+write back data older than the last write. The on_invalidate hook lets the
+loader stop handing such a read to new callers as well.
+"""
+import time
+import asyncio
+import logging
+from collections import OrderedDict
+
+try:
+    import backend.metrics as metrics
+except ImportError:
+    import metrics
+
+logger = logging.getLogger(__name__)
+
+class ReadThroughCache:
+    def __init__(self, name, loader, ttl=60.0, stale_ttl=3600.0, max_entries=128, on_invalidate=None):
+        self.name = name
+        self.loader = loader
+        # Called with the invalidated key, e.g. to stop sharing in-flight loads
+        self.on_invalidate = on_invalidate
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # key -> (loaded_at, value)
+        self._refreshing = {}
+        self._generation = 0
+
+    async def get(self, *key):
+        now = time.monotonic()
+        entry = self._entries.get(key)
+        if entry is not None:
+            age = now - entry[0]
+            if age < self.ttl:
+                self._entries.move_to_end(key)
+                metrics.CACHE_REQUESTS_TOTAL.labels(self.name, "hit").inc()
+                return entry[1]
+            if age < self.ttl + self.stale_ttl:
+                self._entries.move_to_end(key)
+                metrics.CACHE_REQUESTS_TOTAL.labels(self.name, "stale").inc()
+                self._refresh_in_background(key)
+                return entry[1]
+
+        metrics.CACHE_REQUESTS_TOTAL.labels(self.name, "miss").inc()
+        return await self._load(key)
+
+    def peek(self, *key):
+        """Cached value (fresh or stale) without loading; None on a miss."""
+        entry = self._entries.get(key)
+        if entry is None or time.monotonic() - entry[0] >= self.ttl + self.stale_ttl:
+            return None
+        return entry[1]
+
+    async def _load(self, key):
+        generation = self._generation
+        try:
+            value = await self.loader(*key)
+        except Exception:
+            entry = self._entries.get(key)
+            if entry is not None and time.monotonic() - entry[0] < self.ttl + self.stale_ttl:
+                # Upstream down: stale data beats no data
+                metrics.CACHE_REQUESTS_TOTAL.labels(self.name, "stale_on_error").inc()
+                logger.warning("cache %s serving stale data after load failure", self.name)
+                return entry[1]
+            raise
+        if generation == self._generation:
+            self._store(key, value)
+        return value
+
+    def _store(self, key, value):
+        self._entries[key] = (time.monotonic(), value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _refresh_in_background(self, key):
+        if key in self._refreshing:
+            return
+        task = asyncio.get_running_loop().create_task(self._load(key))
+        self._refreshing[key] = task
+
+        def done(t):
+            self._refreshing.pop(key, None)
+            if not t.cancelled() and t.exception() is not None:
+                logger.warning("cache %s background refresh failed: %s", self.name, t.exception())
+        task.add_done_callback(done)
+
+    def invalidate(self, *key):
+        """Drop one entry, or every entry when called without a key."""
+        self._generation += 1
+        if key:
+            self._entries.pop(key, None)
+        else:
+            self._entries.clear()
+        if self.on_invalidate is not None:
+            self.on_invalidate(*key)
+        metrics.CACHE_INVALIDATIONS_TOTAL.labels(self.name).inc()
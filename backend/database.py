@@ -1,152 +1,696 @@
+"""Async data access for the Supabase (PostgREST) backend.
+
+Talks to the REST API directly over a pooled HTTP/2 httpx client with
+timeouts and retry with exponential backoff. Identical concurrent reads are
+coalesced into one upstream request. Point SUPABASE_URL at a local mock
+server (or call configure() with an httpx transport) to test without
+Supabase.
+"""
 import os
+import time
+import uuid
+import random
+import asyncio
+import logging
 from datetime import datetime
-from supabase import create_client, Client
+from collections import OrderedDict
+
+import httpx
 from dotenv import load_dotenv
 
+try:
+    import backend.metrics as metrics
+    from backend.cache import ReadThroughCache
+    from backend.write_queue import WriteQueue
+    from backend.search_index import VehicleIndex
+except ImportError:
+    import metrics
+    from cache import ReadThroughCache
+    from write_queue import WriteQueue
+    from search_index import VehicleIndex
+
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
+DB_TIMEOUT = float(os.environ.get("DB_TIMEOUT", 10))
+DB_MAX_RETRIES = int(os.environ.get("DB_MAX_RETRIES", 3))
+DB_BACKOFF = float(os.environ.get("DB_BACKOFF", 0.2))
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", 10))
+
+# Read cache for vehicles/history; writes through this module invalidate it
+CACHE_TTL = float(os.environ.get("CACHE_TTL", 60))
+CACHE_STALE_TTL = float(os.environ.get("CACHE_STALE_TTL", 3600))
+CACHE_MAX_ENTRIES = int(os.environ.get("CACHE_MAX_ENTRIES", 128))
+
+# Site (apartment complex) used when a request does not name one
+DEFAULT_SITE = os.environ.get("DEFAULT_SITE", "default")
+
+# Full rebuild of the search index from Supabase after this many seconds;
+# writes through this module update it incrementally in between
+SEARCH_INDEX_TTL = float(os.environ.get("SEARCH_INDEX_TTL", 300))
+
+# Rows per upstream request when streaming exports
+EXPORT_PAGE_SIZE = int(os.environ.get("EXPORT_PAGE_SIZE", 500))
+
+# Reports and violations go through a local write-ahead queue
+WRITE_QUEUE_BATCH = int(os.environ.get("WRITE_QUEUE_BATCH", 100))
+WRITE_QUEUE_RETRY_INTERVAL = float(os.environ.get("WRITE_QUEUE_RETRY_INTERVAL", 30))
+# After a transient flush failure the replayer waits WRITE_QUEUE_BACKOFF seconds,
+# doubling per consecutive failure up to WRITE_QUEUE_RETRY_INTERVAL
+WRITE_QUEUE_BACKOFF = float(os.environ.get("WRITE_QUEUE_BACKOFF", 1))
+# Upper bound on the request-path lookup that rejects violations for unknown vehicles
+VEHICLE_CHECK_TIMEOUT = float(os.environ.get("VEHICLE_CHECK_TIMEOUT", 0.5))
+
+# Status codes worth retrying: rate limited or upstream trouble
+RETRY_STATUS = {429, 500, 502, 503, 504}
+# Safe to send twice. A POST is not, unless on_conflict makes it an upsert
+IDEMPOTENT_METHODS = {"GET", "HEAD", "PUT", "PATCH", "DELETE"}
+# Failures that guarantee the request was not processed, so anything may be retried
+UNSENT_STATUS = {429}
+UNSENT_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+
 def log_error(msg):
-    print(f"ERROR: {datetime.now()}: {msg}")
+    logger.error(msg)
+
+def timed(operation):
+    """Record latency of a database operation in db_operation_seconds."""
+    return metrics.DB_OPERATION_SECONDS.labels(operation).time()
+
+class _LeaderCancelled(Exception):
+    """The request a coalesced read was waiting on was cancelled."""
+
+class SupabaseClient:
+    def __init__(self, url, key, timeout=DB_TIMEOUT, max_retries=DB_MAX_RETRIES,
+                 backoff=DB_BACKOFF, pool_size=DB_POOL_SIZE, transport=None):
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self._inflight = {}
+        self._client = httpx.AsyncClient(
+            base_url=f"{url.rstrip('/')}/rest/v1",
+            headers={"apikey": key, "Authorization": f"Bearer {key}"},
+            timeout=timeout,
+            limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size),
+            http2=transport is None,
+            transport=transport,
+        )
+
+    async def request(self, method, table, params=None, json=None, prefer=None, idempotent=None, retries=None):
+        """Send a PostgREST request, retrying transient failures with backoff.
+
+        Non-idempotent requests (plain POSTs) are only retried when they cannot
+        have reached the database, so a lost response never causes a second
+        insert. Pass idempotent=True for POSTs made safe by on_conflict.
+        retries overrides the client's max_retries for one call.
+        """
+        if idempotent is None:
+            idempotent = method in IDEMPOTENT_METHODS
+        max_retries = self.max_retries if retries is None else retries
+        retry_status = RETRY_STATUS if idempotent else UNSENT_STATUS
+        headers = {"Prefer": prefer} if prefer else None
+        for attempt in range(max_retries + 1):
+            try:
+                response = await self._client.request(method, f"/{table}", params=params, json=json, headers=headers)
+                if response.status_code not in retry_status or attempt == max_retries:
+                    response.raise_for_status()
+                    return response.json() if response.content else []
+            except httpx.TransportError as e:
+                if attempt == max_retries or not (idempotent or isinstance(e, UNSENT_ERRORS)):
+                    raise
+            metrics.DB_RETRIES_TOTAL.labels(table).inc()
+            # Exponential backoff with jitter so retries from many workers spread out
+            await asyncio.sleep(self.backoff * (2 ** attempt) * (0.5 + random.random()))
+
+    async def select(self, table, params):
+        """GET rows, sharing one upstream request between identical concurrent reads."""
+        key = (table, tuple(sorted(params.items())))
+        future = self._inflight.get(key)
+        if future is not None:
+            metrics.DB_COALESCED_TOTAL.labels(table).inc()
+            try:
+                return await asyncio.shield(future)
+            except _LeaderCancelled:
+                # The request we were sharing was cancelled, not failed: issue our own
+                return await self.select(table, params)
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            result = await self.request("GET", table, params=params)
+            future.set_result(result)
+            return result
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            # forget() may already have replaced us with a newer read
+            if self._inflight.get(key) is future:
+                del self._inflight[key]
+            if not future.done():
+                # Cancelled (a BaseException), release the followers instead of leaving them waiting
+                future.set_exception(_LeaderCancelled())
+            # Mark retrieved so an unawaited failure is not logged by asyncio
+            future.exception()
+
+    def forget(self, table, **params):
+        """Stop sharing in-flight reads of table whose params include params.
+
+        Called after a write: a read started before it returns pre-write rows,
+        so later callers must start their own. Callers already waiting keep it.
+        """
+        wanted = set(params.items())
+        for key in [k for k in self._inflight if k[0] == table and wanted <= set(k[1])]:
+            del self._inflight[key]
+
+    async def close(self):
+        await self._client.aclose()
+
+supabase: SupabaseClient = None
+
+def configure(url, key, **kwargs):
+    """(Re)create the shared client, e.g. against a mock server in tests."""
+    global supabase
+    supabase = SupabaseClient(url, key, **kwargs)
+    return supabase
+
+async def close():
+    global _replayer
+    if _replayer is not None:
+        _replayer.cancel()
+        _replayer = None
+    if supabase:
+        await supabase.close()
 
 url: str = os.environ.get("SUPABASE_URL")
 key: str = os.environ.get("SUPABASE_KEY")
 
-supabase: Client = None
-
 if url and key:
-    try:
-        supabase = create_client(url, key)
-        log_error("Supabase client initialized successfully.")
-    except Exception as e:
-        log_error(f"Failed to initialize Supabase client: {e}")
+    configure(url, key)
+    logger.info("Supabase client initialized successfully.")
 else:
-    log_error("Warning: SUPABASE_URL or SUPABASE_KEY not found in environment variables.")
-    print("Warning: SUPABASE_URL or SUPABASE_KEY not found in environment variables.")
+    logger.warning("SUPABASE_URL or SUPABASE_KEY not found in environment variables.")
+
+def _first(rows):
+    return rows[0] if rows else None
+
+def _scoped_key(operation, site, target, idempotency_key):
+    """Idempotency key as stored: a client key only dedupes the same write on the same target."""
+    if not idempotency_key:
+        return None
+    return f"{operation}:{site}:{target}:{idempotency_key}"
+
+def _new_id(scoped_key=None):
+    """Collision-free record id; stable for a given scoped key so replays dedupe."""
+    if scoped_key:
+        return uuid.uuid5(uuid.NAMESPACE_URL, scoped_key).hex
+    return uuid.uuid4().hex
+
+def _site_filter(site, **params):
+    """PostgREST params scoped to one site."""
+    params["site"] = f"eq.{site}"
+    return params
+
+async def _fetch_vehicles(site):
+    with timed("get_vehicles"):
+        return await supabase.select("vehicles", _site_filter(site, select="*"))
 
-def get_vehicles():
+def _forget_reads(table):
+    """on_invalidate hook: reads in flight before a write must not serve later callers."""
+    def forget(site=None):
+        if supabase:
+            supabase.forget(table, **({} if site is None else _site_filter(site)))
+    return forget
+
+# Keyed by site, so each site's entry holds only that site's rows
+vehicles_cache = ReadThroughCache("vehicles", _fetch_vehicles, CACHE_TTL, CACHE_STALE_TTL, CACHE_MAX_ENTRIES,
+                                  on_invalidate=_forget_reads("vehicles"))
+
+async def get_vehicles(site=DEFAULT_SITE):
     if not supabase: return []
     try:
-        response = supabase.table("vehicles").select("*").execute()
-        return response.data
+        vehicles = await vehicles_cache.get(site)
     except Exception as e:
+        metrics.DB_ERRORS_TOTAL.labels("get_vehicles").inc()
         log_error(f"Error fetching vehicles: {e}")
-        print(f"Error fetching vehicles: {e}")
         return []
+    return _with_pending_violations(vehicles, site)
+
+def _prepare_vehicle(vehicle, site):
+    vehicle["site"] = site
+    if "id" not in vehicle:
+        vehicle["id"] = _new_id()
 
-def add_vehicle(vehicle):
-    if not supabase: 
+    vehicle["registeredAt"] = datetime.now().isoformat()
+    if "violations" not in vehicle:
+        vehicle["violations"] = []
+    return vehicle
+
+# Upsert on the id assigned in _prepare_vehicle: a retry after a lost
+# response rewrites the same row instead of failing with 409
+VEHICLE_INSERT = dict(params={"on_conflict": "id"}, prefer="resolution=merge-duplicates,return=representation",
+                      idempotent=True)
+
+async def add_vehicle(vehicle, site=DEFAULT_SITE):
+    if not supabase:
         log_error("add_vehicle called but supabase client is None.")
         return None
-    try:
-        if "id" not in vehicle:
-            vehicle["id"] = str(int(datetime.now().timestamp() * 1000))
-        
-        vehicle["registeredAt"] = datetime.now().isoformat()
-        if "violations" not in vehicle:
-            vehicle["violations"] = []
-            
-        response = supabase.table("vehicles").insert(vehicle).execute()
-        return response.data[0] if response.data else None
-    except Exception as e:
-        log_error(f"Error adding vehicle: {e}")
-        print(f"Error adding vehicle: {e}")
-        return None
+    with timed("add_vehicle"):
+        try:
+            rows = await supabase.request("POST", "vehicles", json=_prepare_vehicle(vehicle, site), **VEHICLE_INSERT)
+            vehicles_cache.invalidate(site)
+            for row in rows:
+                _index_for(site).upsert(row)
+            return _first(rows)
+        except Exception as e:
+            metrics.DB_ERRORS_TOTAL.labels("add_vehicle").inc()
+            log_error(f"Error adding vehicle: {e}")
+            return None
 
-def bulk_add_vehicles(vehicles):
+async def bulk_add_vehicles(vehicles, site=DEFAULT_SITE):
     if not supabase: return {"added": [], "failed": []}
+    with timed("bulk_add_vehicles"):
+        for v in vehicles:
+            _prepare_vehicle(v, site)
+        try:
+            # One round trip for the whole sheet
+            added = await supabase.request("POST", "vehicles", json=vehicles, **VEHICLE_INSERT)
+            vehicles_cache.invalidate(site)
+            for row in added:
+                _index_for(site).upsert(row)
+            return {"added": added, "failed": []}
+        except Exception as e:
+            # A single bad row rejects the batch; fall back to row by row to report which
+            log_error(f"Bulk insert failed, retrying row by row: {e}")
+
     added = []
     failed = []
-    
     for v in vehicles:
-        res = add_vehicle(v)
+        res = await add_vehicle(v, site)
         if res:
             added.append(res)
         else:
             failed.append(v)
     return {"added": added, "failed": failed}
 
-def delete_all_vehicles():
+async def delete_all_vehicles(site=DEFAULT_SITE):
     if not supabase: return False
-    try:
-        # Delete all rows. Supabase requires a WHERE clause for delete.
-        # id is not null is a safe bet.
-        response = supabase.table("vehicles").delete().neq("id", "0").execute()
-        return True
-    except Exception as e:
-        log_error(f"Error deleting all vehicles: {e}")
-        return False
+    with timed("delete_all_vehicles"):
+        try:
+            # Delete every row of this site only (Supabase requires a WHERE clause for delete)
+            await supabase.request("DELETE", "vehicles", params=_site_filter(site))
+            vehicles_cache.invalidate(site)
+            _index_for(site).clear()
+            return True
+        except Exception as e:
+            metrics.DB_ERRORS_TOTAL.labels("delete_all_vehicles").inc()
+            log_error(f"Error deleting all vehicles: {e}")
+            return False
 
-def update_vehicle(vehicle_id, updated_data):
+async def update_vehicle(vehicle_id, updated_data, site=DEFAULT_SITE):
     if not supabase: return None
-    try:
-        response = supabase.table("vehicles").update(updated_data).eq("id", vehicle_id).execute()
-        return response.data[0] if response.data else None
-    except Exception as e:
-        log_error(f"Error updating vehicle: {e}")
-        print(f"Error updating vehicle: {e}")
-        return None
+    # A vehicle cannot be moved to another site through an update
+    updated_data.pop("site", None)
+    with timed("update_vehicle"):
+        try:
+            rows = await supabase.request("PATCH", "vehicles", params=_site_filter(site, id=f"eq.{vehicle_id}"),
+                                          json=updated_data, prefer="return=representation")
+            vehicles_cache.invalidate(site)
+            for row in rows:
+                _index_for(site).upsert(row)
+            return _first(rows)
+        except Exception as e:
+            metrics.DB_ERRORS_TOTAL.labels("update_vehicle").inc()
+            log_error(f"Error updating vehicle: {e}")
+            return None
 
-def delete_vehicle(vehicle_id):
+async def delete_vehicle(vehicle_id, site=DEFAULT_SITE):
     if not supabase: return False
+    with timed("delete_vehicle"):
+        try:
+            rows = await supabase.request("DELETE", "vehicles", params=_site_filter(site, id=f"eq.{vehicle_id}"),
+                                          prefer="return=representation")
+            vehicles_cache.invalidate(site)
+            _index_for(site).remove(vehicle_id)
+            return True if rows else False
+        except Exception as e:
+            metrics.DB_ERRORS_TOTAL.labels("delete_vehicle").inc()
+            log_error(f"Error deleting vehicle: {e}")
+            return False
+
+async def _vehicle_exists(vehicle_id, site):
+    """Best-effort check that the vehicle is registered at the site.
+
+    Never waits on a slow Supabase: the local index and cached registry
+    answer first, then a single upstream attempt bounded by
+    VEHICLE_CHECK_TIMEOUT. Without an answer the write is queued anyway and
+    dead-lettered at flush time if the vehicle really is missing.
+    """
+    if _index_for(site).get(vehicle_id) is not None:
+        return True
+    cached = vehicles_cache.peek(site)
+    if cached is not None and any(v.get("id") == vehicle_id for v in cached):
+        return True
+    # Not known here, maybe registered by another worker since our copy was loaded
     try:
-        response = supabase.table("vehicles").delete().eq("id", vehicle_id).execute()
-        return True if response.data else False
+        with timed("get_vehicle"):
+            rows = await asyncio.wait_for(
+                supabase.request("GET", "vehicles", params=_site_filter(site, select="id", id=f"eq.{vehicle_id}"), retries=0),
+                VEHICLE_CHECK_TIMEOUT,
+            )
     except Exception as e:
-        log_error(f"Error deleting vehicle: {e}")
-        print(f"Error deleting vehicle: {e}")
-        return False
+        metrics.DB_ERRORS_TOTAL.labels("get_vehicle").inc()
+        log_error(f"Error checking vehicle {vehicle_id}, queueing anyway: {e}")
+        return True
+    return bool(rows)
+
+async def add_violation(vehicle_id, violation, idempotency_key=None, site=DEFAULT_SITE):
+    """Queue a violation; it is written to Supabase by the replayer.
 
-def add_violation(vehicle_id, violation):
+    Returns None if the vehicle is not registered at the site.
+    """
     if not supabase: return None
-    try:
-        current = supabase.table("vehicles").select("violations").eq("id", vehicle_id).execute()
-        if not current.data:
-            return None
-            
-        violations = current.data[0].get("violations") or []
-        
-        violation["id"] = str(int(datetime.now().timestamp() * 1000))
-        violation["date"] = datetime.now().isoformat()
-        violations.append(violation)
-        
-        response = supabase.table("vehicles").update({"violations": violations}).eq("id", vehicle_id).execute()
-        return response.data[0] if response.data else None
-    except Exception as e:
-        log_error(f"Error adding violation: {e}")
-        print(f"Error adding violation: {e}")
+    if not await _vehicle_exists(vehicle_id, site):
+        return None
+    scoped_key = _scoped_key("add_violation", site, vehicle_id, idempotency_key)
+    violation["id"] = _new_id(scoped_key)
+    violation["date"] = datetime.now().isoformat()
+    payload = {"site": site, "vehicleId": vehicle_id, "violation": violation}
+    payload, _ = write_queue.enqueue("add_violation", payload, scoped_key or violation["id"])
+    _wake_replayer()
+    return {"id": payload["vehicleId"], "violation": payload["violation"], "queued": True}
+
+def _with_pending_violations(vehicles, site):
+    """Overlay queued violations so readers see them before the flush."""
+    pending = {}
+    for _, _, payload in write_queue.pending(WRITE_QUEUE_BATCH * 10, "add_violation"):
+        if payload.get("site", DEFAULT_SITE) != site:
+            continue
+        pending.setdefault(payload["vehicleId"], []).append(payload["violation"])
+    if not pending:
+        return vehicles
+    merged = []
+    for v in vehicles:
+        extra = pending.get(v.get("id"))
+        if extra:
+            # Copy, the list is shared with the cache
+            v = dict(v, violations=(v.get("violations") or []) + extra)
+        merged.append(v)
+    return merged
+
+async def iter_vehicles(site=DEFAULT_SITE, page_size=EXPORT_PAGE_SIZE):
+    """Yield the site's vehicles page by page (keyset on id), bypassing the cache."""
+    if not supabase: return
+    last_id = None
+    while True:
+        params = _site_filter(site, select="*", order="id.asc", limit=str(page_size))
+        if last_id is not None:
+            params["id"] = f"gt.{last_id}"
+        with timed("iter_vehicles"):
+            page = await supabase.request("GET", "vehicles", params=params)
+        if not page:
+            return
+        yield page
+        if len(page) < page_size:
+            return
+        last_id = page[-1]["id"]
+
+# --- Search ---
+
+# One index per site, least recently used dropped past CACHE_MAX_ENTRIES
+_site_indexes = OrderedDict()
+
+def _index_for(site):
+    index = _site_indexes.get(site)
+    if index is None:
+        index = _site_indexes[site] = VehicleIndex()
+        while len(_site_indexes) > CACHE_MAX_ENTRIES:
+            _site_indexes.popitem(last=False)
+    _site_indexes.move_to_end(site)
+    return index
+
+async def _ready_index(site):
+    """The site's index, (re)built from the registry when missing or older than SEARCH_INDEX_TTL."""
+    index = _index_for(site)
+    if not index.built or time.monotonic() - index.built_at > SEARCH_INDEX_TTL:
+        try:
+            index.build(await vehicles_cache.get(site))
+        except Exception as e:
+            metrics.DB_ERRORS_TOTAL.labels("search_vehicles").inc()
+            log_error(f"Error building search index: {e}")
+    return index
+
+async def search_vehicles(query, offset=0, limit=20, site=DEFAULT_SITE):
+    """Search plate (incl. last 4 digits), owner and dong/ho. Returns (total, vehicles)."""
+    if not supabase: return 0, []
+    index = await _ready_index(site)
+    total, page = index.search(query, offset, limit)
+    return total, _with_pending_violations(page, site)
+
+async def find_vehicle_by_plate(plate, site=DEFAULT_SITE):
+    """Registered vehicle with exactly this plate at the site, or None."""
+    if not supabase: return None
+    index = await _ready_index(site)
+    vehicle = index.lookup_plate(plate)
+    if vehicle is None:
         return None
+    return _with_pending_violations([vehicle], site)[0]
 
 # --- History ---
 
-def get_history():
+def _history_from_db(item):
+    # Map snake_case to camelCase
+    if "reporter_name" in item:
+        item["reporterName"] = item.pop("reporter_name")
+    return item
+
+async def _fetch_history(site):
+    with timed("get_history"):
+        data = await supabase.select("history", _site_filter(site, select="*", order="timestamp.desc"))
+        return [_history_from_db(item) for item in data]
+
+history_cache = ReadThroughCache("history", _fetch_history, CACHE_TTL, CACHE_STALE_TTL, CACHE_MAX_ENTRIES,
+                                 on_invalidate=_forget_reads("history"))
+
+async def get_history(site=DEFAULT_SITE):
     if not supabase: return []
     try:
-        response = supabase.table("history").select("*").order("timestamp", desc=True).execute()
-        data = response.data
-        # Map snake_case to camelCase
-        for item in data:
-            if "reporter_name" in item:
-                item["reporterName"] = item.pop("reporter_name")
-        return data
+        history = await history_cache.get(site)
     except Exception as e:
+        metrics.DB_ERRORS_TOTAL.labels("get_history").inc()
         log_error(f"Error fetching history: {e}")
-        print(f"Error fetching history: {e}")
-        return []
+        history = []
+    # Queued reports are newer than anything upstream, list them first
+    pending = [_history_from_db(dict(p)) for _, _, p in write_queue.pending(WRITE_QUEUE_BATCH * 10, "add_history")
+               if p.get("site", DEFAULT_SITE) == site]
+    if not pending:
+        return history
+    pending.reverse()
+    seen = {item["id"] for item in pending}
+    return pending + [item for item in history if item.get("id") not in seen]
+
+async def iter_history(site=DEFAULT_SITE, date_from=None, date_to=None, page_size=EXPORT_PAGE_SIZE):
+    """Yield history newest first, page by page; dates are ISO strings, date_to exclusive.
 
-def add_history(item):
+    Keyset paging on (timestamp, id), like iter_vehicles, so reports added
+    during an export cannot shift later pages and duplicate rows.
+    """
+    if not supabase: return
+    params = _site_filter(site, select="*", order="timestamp.desc,id.desc", limit=str(page_size))
+    bounds = []
+    if date_from:
+        bounds.append(f'timestamp.gte."{date_from}"')
+    if date_to:
+        bounds.append(f'timestamp.lt."{date_to}"')
+    if bounds:
+        params["and"] = f"({','.join(bounds)})"
+    while True:
+        with timed("iter_history"):
+            page = await supabase.request("GET", "history", params=params)
+        if not page:
+            return
+        yield [_history_from_db(item) for item in page]
+        if len(page) < page_size:
+            return
+        # Strictly after the last row in (timestamp desc, id desc) order
+        last_ts, last_id = page[-1]["timestamp"], page[-1]["id"]
+        params["or"] = f'(timestamp.lt."{last_ts}",and(timestamp.eq."{last_ts}",id.lt."{last_id}"))'
+
+async def add_history(item, idempotency_key=None, site=DEFAULT_SITE):
+    """Queue a history entry; the request never waits on Supabase."""
     if not supabase: return None
-    try:
-        if "id" not in item:
-            item["id"] = str(int(datetime.now().timestamp() * 1000))
-        item["timestamp"] = datetime.now().isoformat()
-        
-        # Map camelCase to snake_case for DB
-        if "reporterName" in item:
-            item["reporter_name"] = item.pop("reporterName")
-            
-        response = supabase.table("history").insert(item).execute()
-        return response.data[0] if response.data else None
-    except Exception as e:
-        log_error(f"Error adding history: {e}")
-        print(f"Error adding history: {e}")
-        return None
+    item["site"] = site
+    scoped_key = _scoped_key("add_history", site, "history", idempotency_key)
+    if "id" not in item:
+        item["id"] = _new_id(scoped_key)
+    item["timestamp"] = datetime.now().isoformat()
+
+    # Map camelCase to snake_case for DB
+    if "reporterName" in item:
+        item["reporter_name"] = item.pop("reporterName")
+
+    item, _ = write_queue.enqueue("add_history", item, scoped_key or item["id"])
+    _wake_replayer()
+    return _history_from_db(dict(item))
+
+# --- Write queue replay ---
+
+write_queue = WriteQueue()
+_replayer = None
+_replayer_wakeup = None
+
+def _wake_replayer():
+    if _replayer_wakeup is not None:
+        _replayer_wakeup.set()
+
+async def _flush_history(rows):
+    with timed("add_history"):
+        # Upsert ignoring existing ids makes a replay after a lost response harmless
+        await supabase.request("POST", "history", json=[payload for _, _, payload in rows],
+                               params={"on_conflict": "id"},
+                               prefer="resolution=ignore-duplicates,return=minimal", idempotent=True)
+    for site in {payload.get("site", DEFAULT_SITE) for _, _, payload in rows}:
+        history_cache.invalidate(site)
+
+async def _flush_violations(site, vehicle_id, rows):
+    with timed("add_violation"):
+        current = await supabase.request("GET", "vehicles", params=_site_filter(site, select="violations", id=f"eq.{vehicle_id}"))
+        if not current:
+            # Deleted after the violation was queued; keep the report in dead_writes
+            raise PermanentWriteError(f"vehicle {vehicle_id} not found")
+        violations = current[0].get("violations") or []
+        existing = {v.get("id") for v in violations}
+        new = [p["violation"] for _, _, p in rows if p["violation"]["id"] not in existing]
+        if new:
+            updated = await supabase.request("PATCH", "vehicles", params=_site_filter(site, id=f"eq.{vehicle_id}"),
+                                             json={"violations": violations + new}, prefer="return=representation")
+            for row in updated:
+                _index_for(site).upsert(row)
+    # Violations are embedded in the vehicle rows
+    vehicles_cache.invalidate(site)
+
+class PermanentWriteError(Exception):
+    """A queued write that can never succeed as it stands."""
+
+def _is_permanent(error):
+    """True if sending the same rows again will fail the same way (4xx other than 408/429)."""
+    if isinstance(error, PermanentWriteError):
+        return True
+    if isinstance(error, httpx.HTTPStatusError):
+        status = error.response.status_code
+        return 400 <= status < 500 and status not in (408, 429)
+    return False
+
+async def _flush_group(key, group):
+    if key[0] == "history":
+        await _flush_history(group)
+    else:
+        await _flush_violations(key[1], key[2], group)
+
+def _flush_done(group):
+    write_queue.remove([seq for seq, _, _ in group])
+    metrics.WRITE_QUEUE_FLUSHED_TOTAL.labels(group[0][1]).inc(len(group))
+
+def _flush_failed(key, group, error):
+    seqs = [seq for seq, _, _ in group]
+    metrics.DB_ERRORS_TOTAL.labels("flush_" + key[0]).inc()
+    if _is_permanent(error):
+        write_queue.dead_letter(seqs, error)
+        metrics.WRITE_QUEUE_DEAD_TOTAL.labels(group[0][1]).inc(len(seqs))
+        log_error(f"Write queue dead-lettered {len(seqs)} {key[0]} write(s): {error}")
+        return
+    # Transient (unreachable, 5xx): keep the rows and back off by time
+    write_queue.mark_failed(seqs, error)
+    _note_outage()
+    log_error(f"Write queue flush failed ({key[0]}), retrying in {_retry_at - time.monotonic():.1f}s: {error}")
+
+# Replayer backoff while Supabase is unreachable; time based, so write traffic
+# (every enqueue wakes the replayer) does not turn into extra attempts
+_failures = 0
+_retry_at = 0.0
+
+def _note_outage():
+    global _failures, _retry_at
+    delay = min(WRITE_QUEUE_BACKOFF * 2 ** _failures, WRITE_QUEUE_RETRY_INTERVAL)
+    _failures += 1
+    _retry_at = time.monotonic() + delay
+
+def _note_recovery():
+    global _failures, _retry_at
+    _failures = 0
+    _retry_at = 0.0
+
+def backing_off():
+    """True while the replayer is waiting out a transient failure."""
+    return time.monotonic() < _retry_at
+
+async def flush_pending_writes(batch_size=WRITE_QUEUE_BATCH):
+    """Send one batch of queued writes upstream. Returns the number flushed.
+
+    Stops at the first transient failure: the rest of the batch would hit the
+    same outage.
+    """
+    rows = write_queue.pending(batch_size)
+    if not rows:
+        return 0
+
+    groups = {}
+    for row in rows:
+        seq, operation, payload = row
+        if operation == "add_history":
+            key = ("history",)
+        else:
+            key = ("violation", payload.get("site", DEFAULT_SITE), payload["vehicleId"])
+        groups.setdefault(key, []).append(row)
+
+    flushed = 0
+    for key, group in groups.items():
+        try:
+            await _flush_group(key, group)
+        except Exception as e:
+            if not (_is_permanent(e) and len(group) > 1):
+                _flush_failed(key, group, e)
+                if _is_permanent(e):
+                    continue
+                return flushed
+            # One bad row rejects the whole batch; send row by row so only it is held back
+            for row in group:
+                try:
+                    await _flush_group(key, [row])
+                except Exception as e:
+                    _flush_failed(key, [row], e)
+                    if _is_permanent(e):
+                        continue
+                    return flushed
+                _flush_done([row])
+                flushed += 1
+            continue
+        _flush_done(group)
+        flushed += len(group)
+    _note_recovery()
+    return flushed
+
+async def _run_replayer():
+    while True:
+        # Wait out a transient failure; enqueue wake-ups do not cut this short
+        delay = _retry_at - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        flushed = 0
+        try:
+            flushed = await flush_pending_writes()
+        except Exception as e:
+            log_error(f"Write queue replay failed: {e}")
+        if backing_off() or (flushed and write_queue.depth()):
+            continue
+        _replayer_wakeup.clear()
+        try:
+            await asyncio.wait_for(_replayer_wakeup.wait(), WRITE_QUEUE_RETRY_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+
+def start_replayer():
+    """Start the background replayer on the running event loop."""
+    global _replayer, _replayer_wakeup
+    if supabase and _replayer is None:
+        _replayer_wakeup = asyncio.Event()
+        _replayer = asyncio.get_running_loop().create_task(_run_replayer())
@@ -0,0 +1,104 @@
+"""Streaming CSV/XLSX export of the registry and history log.
+
+Rows are pulled from database.py page by page and written out as they
+arrive: CSV chunks go straight to the response, XLSX rows go to an openpyxl
+write-only workbook (which spools to disk) that is streamed once saved.
+Memory use stays at one page regardless of table size.
+"""
+import io
+import os
+import csv
+import tempfile
+
+from fastapi.concurrency import run_in_threadpool
+
+TYPE_LABELS = {"resident": "입주민", "staff": "직원", "unidentified": "미확인"}
+
+VEHICLE_COLUMNS = [
+    ("차량번호", lambda v: v.get("plateNumber")),
+    ("차주명", lambda v: v.get("ownerName")),
+    ("동", lambda v: v.get("dong")),
+    ("호", lambda v: v.get("ho")),
+    ("전화번호", lambda v: v.get("phoneNumber")),
+    ("구분", lambda v: TYPE_LABELS.get(v.get("type"), v.get("type"))),
+    ("위반횟수", lambda v: len(v.get("violations") or [])),
+    ("등록일시", lambda v: v.get("registeredAt")),
+]
+
+HISTORY_COLUMNS = [
+    ("일시", lambda h: h.get("timestamp")),
+    ("구분", lambda h: {"call": "호출", "report": "신고"}.get(h.get("type"), h.get("type"))),
+    ("차량번호", lambda h: h.get("plateNumber")),
+    ("차주명", lambda h: h.get("ownerName")),
+    ("동호수", lambda h: h.get("unitNumber")),
+    ("사유", lambda h: h.get("note")),
+    ("내용", lambda h: h.get("description")),
+    ("신고자", lambda h: h.get("reporterName")),
+    ("사진", lambda h: h.get("image")),
+]
+
+CHUNK_SIZE = 64 * 1024
+
+def _values(columns, item):
+    return ["" if value is None else value for value in (getter(item) for _, getter in columns)]
+
+async def csv_stream(columns, pages):
+    """Yield UTF-8 CSV chunks, one per page of rows."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    # BOM so Excel opens Hangul correctly
+    buffer.write("\ufeff")
+    writer.writerow([name for name, _ in columns])
+    async for page in pages:
+        for item in page:
+            writer.writerow(_values(columns, item))
+        yield buffer.getvalue().encode("utf-8")
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode("utf-8")
+
+async def xlsx_file(columns, pages, sheet_title):
+    """Write pages into a write-only workbook; returns the temp file path."""
+    from openpyxl import Workbook
+
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet(sheet_title)
+    sheet.append([name for name, _ in columns])
+    async for page in pages:
+        for item in page:
+            sheet.append(_values(columns, item))
+
+    fd, path = tempfile.mkstemp(suffix=".xlsx")
+    os.close(fd)
+    await run_in_threadpool(workbook.save, path)
+    return path
+
+def file_stream(path):
+    """Stream a file in chunks and delete it afterwards."""
+    try:
+        with open(path, "rb") as f:
+            while True:
+                chunk = f.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                yield chunk
+    finally:
+        os.remove(path)
+
+def template_bytes():
+    """Registration template workbook (built once by the caller and cached)."""
+    import pandas as pd
+
+    # Create a sample dataframe
+    df = pd.DataFrame({
+        "차량번호": ["12가3456", "34나5678"],
+        "차주명": ["홍길동", "김철수"],
+        "동": ["101", "102"],
+        "호": ["1001", "202"],
+        "전화번호": ["010-1234-5678", "010-9876-5432"],
+        "구분": ["입주민", "직원"] # resident, staff
+    })
+    buffer = io.BytesIO()
+    df.to_excel(buffer, index=False)
+    return buffer.getvalue()
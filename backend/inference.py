@@ -0,0 +1,419 @@
+"""Plate recognition pipeline: car detection, plate detection and OCR.
+
+This is the only module that imports the ML stack (torch, PaddleOCR, OpenCV,
+numpy, PIL). main.py imports it on the first /analyze request, or forwards
+images to a separate inference service (inference_service.py) when
+INFERENCE_URL is set, so CRUD and static serving start without it.
+"""
+import io
+import os
+import time
+import logging
+
+import torch
+from paddleocr import PaddleOCR
+import numpy as np
+import cv2
+from PIL import Image
+
+try:
+    import backend.metrics as metrics
+    import backend.memory as memory
+    from backend.model_manager import manager as models
+    import backend.plates as plates
+except ImportError:
+    import metrics
+    import memory
+    from model_manager import manager as models
+    import plates
+
+# Suppress Paddle logs
+logging.getLogger("ppocr").setLevel(logging.ERROR)
+
+def load_car_model():
+    # Memory optimization for Render Free Tier (512MB RAM limit)
+    torch.set_grad_enabled(False)
+    torch.set_num_threads(1)
+    
+    # Load YOLOv5 models
+    # Note: We use the local path for custom model, but 'yolov5s' is loaded from hub
+    # Force CPU to avoid MPS/CPU mismatch errors on Mac
+    # Use 'yolov5n' (nano) to save memory
+    car_model = torch.hub.load("ultralytics/yolov5", 'yolov5n', force_reload=False, skip_validation=True, device='cpu')
+    car_model.classes = [2, 3, 5, 7] # Car, Motorcycle, Bus, Truck
+    return car_model
+
+def load_lp_model():
+    BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+    # Use absolute path for lp_det.pt
+    lp_path = os.path.join(BASE_DIR, 'lp_det.pt')
+    return torch.hub.load('ultralytics/yolov5', 'custom', lp_path, device='cpu')
+
+def load_reader():
+    # Initialize PaddleOCR
+    # use_angle_cls=False for speed, lang='korean'
+    # use_gpu=False explicit
+    return PaddleOCR(use_angle_cls=False, lang='korean', use_gpu=False, show_log=False)
+
+# Models are loaded lazily and evicted when idle (see model_manager.py)
+models.register("car", load_car_model)
+models.register("lp", load_lp_model)
+models.register("ocr", load_reader)
+
+def get_car_model():
+    return models.get("car")
+
+def get_lp_model():
+    return models.get("lp")
+
+def get_reader():
+    return models.get("ocr")
+
+memory.register_unload_hook(models.evict_for_pressure)
+
+# Format validity weights used when ranking readings
+FULL_MATCH_WEIGHT = 1.0   # OCR text is exactly a plate
+NOISY_MATCH_WEIGHT = 0.8  # Plate found inside extra characters
+TRIMMED_MATCH_WEIGHT = 0.5  # 3-digit read re-interpreted as 2-digit plate
+
+# Number of alternative readings returned per plate
+PLATE_TOP_K = int(os.environ.get("PLATE_TOP_K", 3))
+# Stop scanning further cars once a plate reaches this confidence
+EARLY_EXIT_CONFIDENCE = float(os.environ.get("EARLY_EXIT_CONFIDENCE", 0.9))
+
+def decode_plate_candidates(lines, det_conf=1.0, top_k=PLATE_TOP_K):
+    """Rank plate readings from PaddleOCR lines.
+
+    lines: list of (text, conf) tuples as returned by PaddleOCR.
+    Each reading is scored as detector score x OCR confidence x format validity.
+    Returns up to top_k dicts {"text", "confidence", "trimmed"}, best first;
+    trimmed marks a 2-digit plate guessed by dropping a digit the OCR did read.
+    """
+    if not lines:
+        return []
+
+    texts = [plates.normalize(text) for text, _ in lines]
+    confs = [float(conf) for _, conf in lines]
+
+    # Old-style plates are often split over two lines, so try the joined text
+    # (scored by its weakest line) as well as every line on its own.
+    sources = [("".join(texts), min(confs))]
+    if len(texts) > 1:
+        sources.extend(zip(texts, confs))
+
+    scores = {}
+    trimmed_plates = set()
+    for text, conf in sources:
+        for match in plates.PLATE_PATTERN.finditer(text):
+            plate = match.group(0)
+            validity = FULL_MATCH_WEIGHT if plate == text else NOISY_MATCH_WEIGHT
+            score = det_conf * conf * validity
+            scores[plate] = max(scores.get(plate, 0.0), score)
+            trimmed_plates.discard(plate)
+
+            # A 3-digit prefix may be a 2-digit plate with a spurious digit
+            if len(match.group(1)) == 3:
+                trimmed = plate[1:]
+                score = det_conf * conf * TRIMMED_MATCH_WEIGHT
+                if trimmed not in scores:
+                    trimmed_plates.add(trimmed)
+                scores[trimmed] = max(scores.get(trimmed, 0.0), score)
+
+    ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)
+    return [{"text": text, "confidence": round(score, 4), "trimmed": text in trimmed_plates}
+            for text, score in ranked[:top_k]]
+
+# Cascade: accept the recognition-only read when it is a clean plate at this confidence
+OCR_CASCADE = os.environ.get("OCR_CASCADE", "1") == "1"
+CASCADE_ACCEPT_CONFIDENCE = float(os.environ.get("CASCADE_ACCEPT_CONFIDENCE", 0.85))
+
+def recognize_fast(ocr_reader, img_np):
+    """Recognition-only OCR on a tight plate crop (no text-detection step).
+
+    Returns the (text, conf) lines if the read is a well-formed plate with high
+    confidence, otherwise None so the caller falls back to full PaddleOCR.
+    """
+    start = time.perf_counter()
+    result = ocr_reader.ocr(img_np, det=False, cls=False)
+    metrics.OCR_STAGE_SECONDS.labels("rec_only").observe(time.perf_counter() - start)
+
+    # det=False returns [[("text", conf), ...]]
+    if not result or not result[0]:
+        return None
+    text, conf = result[0][0]
+    if conf >= CASCADE_ACCEPT_CONFIDENCE and plates.classify(plates.normalize(text)) != plates.INVALID:
+        return result[0]
+    return None
+
+def recognize_plate(plate_img_pil, det_conf=1.0):
+    """Run OCR on a plate crop and return ranked readings (best first)."""
+    # Lazy load reader
+    ocr_reader = get_reader()
+
+    # Convert to numpy (RGB)
+    img_np = np.array(plate_img_pil)
+
+    # PaddleOCR expects BGR usually if read via cv2, but check doc.
+    # Actually PaddleOCR uses cv2.imread which is BGR.
+    # If we pass RGB numpy array, it should be fine if we are consistent or convert.
+    # Let's convert to BGR for safety as it's standard OpenCV format expected by many libs.
+    if img_np.ndim == 3 and img_np.shape[2] == 3:
+        # In place, avoids a second full-size copy per crop
+        cv2.cvtColor(img_np, cv2.COLOR_RGB2BGR, dst=img_np)
+    elif img_np.ndim == 3:
+        img_np = img_np[:, :, ::-1].copy() # RGB to BGR
+
+    # Stage 1: the crop is already a tight plate box, try recognition only
+    if OCR_CASCADE:
+        lines = recognize_fast(ocr_reader, img_np)
+        if lines:
+            metrics.OCR_CASCADE_TOTAL.labels("accepted").inc()
+            return decode_plate_candidates(lines, det_conf)
+        metrics.OCR_CASCADE_TOTAL.labels("fallback").inc()
+
+    # Stage 2: full PaddleOCR (detection + recognition)
+    # cls=False for speed
+    start = time.perf_counter()
+    result = ocr_reader.ocr(img_np, cls=False)
+    metrics.OCR_STAGE_SECONDS.labels("full").observe(time.perf_counter() - start)
+
+    # result is a list of lists (one per image). Since we send one image: result[0]
+    if not result or result[0] is None:
+        return []
+
+    # line: [[ [x1,y1], ... ], ("text", conf)]
+    return decode_plate_candidates([line[1] for line in result[0]], det_conf)
+
+def _plate_result(candidates, box):
+    best = candidates[0]
+    return {
+        "text": best["text"],
+        "confidence": best["confidence"],
+        "box": box,
+        "alternatives": candidates[1:],
+    }
+
+def stage(name):
+    """Time a pipeline stage into pipeline_stage_seconds."""
+    return metrics.PIPELINE_STAGE_SECONDS.labels(name).time()
+
+def detect_single_scale(im):
+    """Cars at the detector's default size, then plates on each car crop."""
+    # Lazy load models
+    car_net = get_car_model()
+    
+    # 1. Detect Cars
+    with stage("car_detection"):
+        results = car_net(im)
+    locs = results.xyxy[0]
+    
+    detected_texts = []
+
+    if len(locs) == 0:
+        # No car detected, try detecting plate on whole image
+        lp_net = get_lp_model()
+        with stage("plate_detection"):
+            lp_results = lp_net(im)
+        for rslt in lp_results.xyxy[0]:
+            x1, y1, x2, y2 = [int(x) for x in rslt[:4]]
+            plate_crop = im.crop((x1, y1, x2, y2))
+            with stage("ocr"):
+                candidates = recognize_plate(plate_crop, float(rslt[4]))
+            if candidates:
+                detected_texts.append(_plate_result(candidates, [x1, y1, x2, y2]))
+    else:
+        # Car detected, crop car then detect plate
+        # Load LP model
+        lp_net = get_lp_model()
+        
+        for *box, conf, cls in locs:
+            x1, y1, x2, y2 = [int(x) for x in box]
+            car_crop = im.crop((x1, y1, x2, y2))
+            
+            with stage("plate_detection"):
+                lp_results = lp_net(car_crop)
+            for rslt in lp_results.xyxy[0]:
+                px1, py1, px2, py2 = [int(x) for x in rslt[:4]]
+                # Calculate absolute coordinates on original image
+                abs_x1 = x1 + px1
+                abs_y1 = y1 + py1
+                abs_x2 = x1 + px2
+                abs_y2 = y1 + py2
+                
+                plate_crop = car_crop.crop((px1, py1, px2, py2))
+                with stage("ocr"):
+                    candidates = recognize_plate(plate_crop, float(rslt[4]))
+                del plate_crop
+                if candidates:
+                    detected_texts.append(_plate_result(candidates, [abs_x1, abs_y1, abs_x2, abs_y2]))
+            del car_crop, lp_results
+
+            # A confident read is good enough, skip the remaining cars
+            if any(r["confidence"] >= EARLY_EXIT_CONFIDENCE for r in detected_texts):
+                break
+
+    return detected_texts
+
+# --- Adaptive pyramid ---
+# The single-scale path shrinks the whole frame to the detector's input size,
+# so on wide, high-resolution shots distant plates are a few pixels by the
+# time the detectors see them. The pyramid runs a coarse pass (cars and
+# plates on the whole frame at COARSE_SIZE), reads plates that were already
+# big enough from the full-resolution frame, and spends high-resolution tiles
+# only on cars whose plate came out too small or was not found.
+#
+# Sizes are compared in detector-input pixels: YOLOv5 letterboxes an input to
+# `size` on its long side, so a frame's effective scale is size / max(w, h).
+# Black letterbox/pillarbox bars are trimmed first so they do not inflate the
+# long side and shrink everything else.
+PYRAMID = os.environ.get("PYRAMID", "1") == "1"
+# Detector input size (long side) for the coarse whole-frame pass
+COARSE_SIZE = int(os.environ.get("COARSE_SIZE", 640))
+# Plates shorter than this at the coarse scale get a high-resolution tile
+PLATE_MIN_PIXELS = float(os.environ.get("PLATE_MIN_PIXELS", 12))
+# Compute budgets: tiles per frame, detector input size and plates read per tile
+TILE_MAX_COUNT = int(os.environ.get("TILE_MAX_COUNT", 4))
+TILE_MAX_SIZE = int(os.environ.get("TILE_MAX_SIZE", 1280))
+TILE_MAX_PLATES = int(os.environ.get("TILE_MAX_PLATES", 2))
+# Context kept around a car when cutting its tile (fraction of the box size)
+TILE_MARGIN = float(os.environ.get("TILE_MARGIN", 0.1))
+# Edge rows/columns whose brightest pixel is at most this are letterbox bars
+LETTERBOX_LEVEL = int(os.environ.get("LETTERBOX_LEVEL", 16))
+
+DETECTOR_SIZE = 640  # YOLOv5 default input size
+DETECTOR_STRIDE = 32
+
+def letterbox_bounds(im):
+    """Box (x1, y1, x2, y2) of im without uniform dark bars on its edges."""
+    width, height = im.size
+    factor = max(1, max(width, height) // 256)
+    # A reduced grey copy finds the bar edges to within `factor` pixels
+    gray = np.asarray(im.convert("L").reduce(factor))
+    rows = np.flatnonzero(gray.max(axis=1) > LETTERBOX_LEVEL)
+    cols = np.flatnonzero(gray.max(axis=0) > LETTERBOX_LEVEL)
+    if len(rows) == 0 or len(cols) == 0:
+        # Uniformly dark frame, nothing to trim against
+        return (0, 0, width, height)
+    # Round outwards so no content is cut
+    return (
+        max(0, int(cols[0] - 1) * factor),
+        max(0, int(rows[0] - 1) * factor),
+        min(width, int(cols[-1] + 2) * factor),
+        min(height, int(rows[-1] + 2) * factor),
+    )
+
+def detector_scale(size, width, height):
+    """Scale the letterbox resize applies to a width x height input at `size`."""
+    return size / max(width, height)
+
+def tile_size(width, height):
+    """Detector input size for a tile: its native resolution, within budget."""
+    native = -(-max(width, height) // DETECTOR_STRIDE) * DETECTOR_STRIDE
+    return min(TILE_MAX_SIZE, max(DETECTOR_SIZE, native))
+
+def _inside(inner, outer):
+    """True if the centre of box inner lies in box outer."""
+    cx = (inner[0] + inner[2]) / 2
+    cy = (inner[1] + inner[3]) / 2
+    return outer[0] <= cx <= outer[2] and outer[1] <= cy <= outer[3]
+
+def _expand(box, margin, width, height):
+    x1, y1, x2, y2 = box
+    dx = (x2 - x1) * margin
+    dy = (y2 - y1) * margin
+    return [max(0, int(x1 - dx)), max(0, int(y1 - dy)), min(width, int(x2 + dx)), min(height, int(y2 + dy))]
+
+def _boxes(results, ox=0, oy=0):
+    """[(box, conf)] from a YOLOv5 result, offset to frame coordinates, best first."""
+    found = []
+    for row in results.xyxy[0]:
+        x1, y1, x2, y2 = [int(v) for v in row[:4]]
+        found.append(([x1 + ox, y1 + oy, x2 + ox, y2 + oy], float(row[4])))
+    found.sort(key=lambda item: item[1], reverse=True)
+    return found
+
+def _read_plate(im, box, det_conf):
+    """OCR the plate at box (full-resolution coordinates); None if unreadable."""
+    plate_crop = im.crop(box)
+    with stage("ocr"):
+        candidates = recognize_plate(plate_crop, det_conf)
+    return _plate_result(candidates, box) if candidates else None
+
+def detect_pyramid(im):
+    width, height = im.size
+    bounds = letterbox_bounds(im)
+    frame = im if bounds == (0, 0, width, height) else im.crop(bounds)
+    scale = detector_scale(COARSE_SIZE, *frame.size)
+
+    car_net = get_car_model()
+    lp_net = get_lp_model()
+
+    # 1. Coarse pass over the whole (trimmed) frame
+    with stage("car_detection"):
+        cars = _boxes(car_net(frame, size=COARSE_SIZE), bounds[0], bounds[1])
+    with stage("plate_detection"):
+        coarse_plates = _boxes(lp_net(frame, size=COARSE_SIZE), bounds[0], bounds[1])
+    del frame
+
+    # 2. Plates already big enough are read from the full-resolution frame
+    detected_texts = []
+    read_boxes = []
+    small = []
+    for box, det_conf in coarse_plates:
+        if (box[3] - box[1]) * scale < PLATE_MIN_PIXELS:
+            small.append(box)
+            continue
+        result = _read_plate(im, box, det_conf)
+        if result:
+            detected_texts.append(result)
+            read_boxes.append(box)
+
+    # 3. Tiles for cars without a readable plate, and for small plates no car was found around
+    tiles = []
+    for car, _ in cars:
+        if any(_inside(box, car) for box in read_boxes):
+            continue
+        reason = "small_plate" if any(_inside(box, car) for box in small) else "no_plate"
+        tiles.append((_expand(car, TILE_MARGIN, width, height), reason))
+    for box in small:
+        if not any(_inside(box, car) for car, _ in cars):
+            tiles.append((_expand(box, 1.0, width, height), "small_plate"))
+
+    # 4. High-resolution tiles, each within its own budget
+    for tile, reason in tiles[:TILE_MAX_COUNT]:
+        # A confident read is good enough, skip the remaining tiles
+        if any(r["confidence"] >= EARLY_EXIT_CONFIDENCE for r in detected_texts):
+            break
+        metrics.PYRAMID_TILES_TOTAL.labels(reason).inc()
+        tile_crop = im.crop(tile)
+        with stage("tile_detection"):
+            lp_results = lp_net(tile_crop, size=tile_size(*tile_crop.size))
+        del tile_crop
+        for box, det_conf in _boxes(lp_results, tile[0], tile[1])[:TILE_MAX_PLATES]:
+            # Overlapping tiles see the same plate
+            if any(_inside(box, read) for read in read_boxes):
+                continue
+            result = _read_plate(im, box, det_conf)
+            if result:
+                detected_texts.append(result)
+                read_boxes.append(box)
+        del lp_results
+
+    return detected_texts
+
+@stage("total")
+def process_image(image_bytes):
+    with stage("decode"):
+        im = Image.open(io.BytesIO(image_bytes))
+        # Image.open is lazy, force the decode so it is measured here
+        im.load()
+
+    detected_texts = detect_pyramid(im) if PYRAMID else detect_single_scale(im)
+
+    # No per-request gc.collect(): crops are freed by refcounting as soon as
+    # they go out of scope, and memory.py collects off the request path.
+
+    # Best reading first
+    detected_texts.sort(key=lambda r: r["confidence"], reverse=True)
+    metrics.PLATES_DETECTED_TOTAL.inc(len(detected_texts))
+    return detected_texts
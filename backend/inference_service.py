@@ -0,0 +1,67 @@
+"""Inference-only service: the recognition pipeline behind an internal API.
+
+Runs the ML stack in its own process so the API process (main.py) stays
+small. Start it with
+
+    uvicorn backend.inference_service:app --port 8001
+
+and point the API process at it with INFERENCE_URL=http://localhost:8001.
+POST /infer takes the raw image bytes and returns {"results": [...]} in the
+same shape as inference.process_image. Not meant to be exposed publicly.
+"""
+import contextlib
+import os
+import logging
+
+from fastapi import FastAPI, Request, Response
+from fastapi.concurrency import run_in_threadpool
+
+logging.basicConfig(
+    level=os.environ.get("LOG_LEVEL", "INFO").upper(),
+    format="%(asctime)s %(levelname)s %(name)s %(message)s",
+)
+
+try:
+    import backend.metrics as metrics
+    import backend.memory as memory
+    from backend.model_manager import manager as models
+    import backend.inference as inference
+except ImportError:
+    import metrics
+    import memory
+    from model_manager import manager as models
+    import inference
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    memory.start()
+    models.start()
+    yield
+
+app = FastAPI(lifespan=lifespan)
+
+@app.middleware("http")
+async def track_in_flight(request, call_next):
+    # Lets memory.py defer gc.freeze() until no request is running
+    with memory.request_scope():
+        return await call_next(request)
+
+@app.post("/infer")
+async def infer(request: Request):
+    contents = await request.body()
+    with metrics.ANALYZE_QUEUE_DEPTH.track_inprogress():
+        results = await run_in_threadpool(inference.process_image, contents)
+    return {"results": results}
+
+@app.get("/healthz")
+def healthz():
+    return {"status": "ok"}
+
+@app.get("/metrics")
+def get_metrics():
+    body, content_type = metrics.render()
+    return Response(body, media_type=content_type)
+
+if __name__ == "__main__":
+    import uvicorn
+    uvicorn.run(app, host="0.0.0.0", port=int(os.environ.get("PORT", 8001)))
@@ -1,18 +1,50 @@
-from fastapi import FastAPI, UploadFile, File
+from fastapi import FastAPI, UploadFile, File, Depends, Header, HTTPException, Query, Request, Response
+from typing import List, Literal, Optional
 from fastapi.middleware.cors import CORSMiddleware
-import torch
-from paddleocr import PaddleOCR
-import numpy as np
-import cv2
-from PIL import Image
+import contextlib
 import io
 import re
+import os
 import logging
+import importlib
+import threading
+import httpx
+from fastapi.concurrency import run_in_threadpool
 
-# Suppress Paddle logs
-logging.getLogger("ppocr").setLevel(logging.ERROR)
-
-app = FastAPI()
+try:
+    import backend.metrics as metrics
+    import backend.memory as memory
+    from backend.model_manager import manager as models
+    import backend.plates as plates
+except ImportError:
+    import metrics
+    import memory
+    from model_manager import manager as models
+    import plates
+
+logging.basicConfig(
+    level=os.environ.get("LOG_LEVEL", "INFO").upper(),
+    format="%(asctime)s %(levelname)s %(name)s %(message)s",
+)
+logger = logging.getLogger("parking")
+
+# httpx logs every Supabase request at INFO
+logging.getLogger("httpx").setLevel(logging.WARNING)
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    memory.start()
+    models.start()
+    if INFERENCE_PRELOAD and not INFERENCE_URL:
+        threading.Thread(target=load_inference, name="inference-import", daemon=True).start()
+    db.start_replayer()
+    yield
+    if _inference_client is not None:
+        await _inference_client.aclose()
+    await db.close()
+
+# Large payloads go through responses.negotiate, which already encodes with orjson
+app = FastAPI(lifespan=lifespan)
 
 # Allow CORS for frontend
 app.add_middleware(
@@ -29,185 +61,127 @@ BACKEND_VERSION = "v1.2.0 (PaddleOCR)"
 async def get_version():
     return {"version": BACKEND_VERSION}
 
-import gc
-import os
-
-# Global models
-car_model = None
-lp_model = None
-reader = None
-
-def get_car_model():
-    global car_model
-    if car_model is None:
-        print("Loading Car Model...")
-        # Memory optimization for Render Free Tier (512MB RAM limit)
-        torch.set_grad_enabled(False)
-        torch.set_num_threads(1)
-        
-        # Load YOLOv5 models
-        # Note: We use the local path for custom model, but 'yolov5s' is loaded from hub
-        # Force CPU to avoid MPS/CPU mismatch errors on Mac
-        # Use 'yolov5n' (nano) to save memory
-        car_model = torch.hub.load("ultralytics/yolov5", 'yolov5n', force_reload=False, skip_validation=True, device='cpu')
-        car_model.classes = [2, 3, 5, 7] # Car, Motorcycle, Bus, Truck
-    return car_model
-
-def get_lp_model():
-    global lp_model
-    if lp_model is None:
-        print("Loading Custom LP Model...")
-        BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-        # Use absolute path for lp_det.pt
-        lp_path = os.path.join(BASE_DIR, 'lp_det.pt')
-        lp_model = torch.hub.load('ultralytics/yolov5', 'custom', lp_path, device='cpu')
-    return lp_model
-
-def get_reader():
-    global reader
-    if reader is None:
-        print("Loading PaddleOCR...")
-        # Initialize PaddleOCR
-        # use_angle_cls=False for speed, lang='korean'
-        # use_gpu=False explicit
-        reader = PaddleOCR(use_angle_cls=False, lang='korean', use_gpu=False, show_log=False)
-    return reader
-
-def process_image(image_bytes):
-    im = Image.open(io.BytesIO(image_bytes))
-    # Convert to numpy for some ops if needed, but YOLO takes PIL
-    
-    # Lazy load models
-    car_net = get_car_model()
-    
-    # 1. Detect Cars
-    results = car_net(im)
-    locs = results.xyxy[0]
-    
-    detected_texts = []
-    
-    # Get reader lazily if needed (will be used inside helper)
-    
-    # Helper to process plate with PaddleOCR
-    def recognize_plate(plate_img_pil):
-        # Lazy load reader
-        ocr_reader = get_reader()
-        
-        # Convert to numpy (RGB)
-        img_np = np.array(plate_img_pil)
-        
-        # PaddleOCR expects BGR usually if read via cv2, but check doc. 
-        # Actually PaddleOCR uses cv2.imread which is BGR.
-        # If we pass RGB numpy array, it should be fine if we are consistent or convert.
-        # Let's convert to BGR for safety as it's standard OpenCV format expected by many libs.
-        if img_np.ndim == 3:
-            img_np = img_np[:, :, ::-1].copy() # RGB to BGR
-        
-        # Run OCR
-        # cls=False for speed
-        result = ocr_reader.ocr(img_np, cls=False)
-        
-        # result is a list of lists (one per image). Since we send one image: result[0]
-        if not result or result[0] is None:
-            return None
-            
-        # Parse results
-        full_text = ""
-        for line in result[0]:
-            # line: [[ [x1,y1], ... ], ("text", conf)]
-            text, conf = line[1]
-            full_text += text
-            
-        full_text = full_text.replace(" ", "")
-        
-        # Regex Validation
-        # License Plate Character whitelist - Official Korean LP characters
-        valid_korean = '가나다라마거너더러머버서어저고노도로모보소오조구누두루무부수우주아바사자배하허호'
-        # Regex to capture patterns like 12가3456 or 123가4567
-        # Allow some noise but look for the structure
-        match = re.search(r'([0-9]{2,3})[' + valid_korean + r']([0-9]{4})', full_text)
-        
-        if match:
-            return match.group(0)
-            
-        return None
-
-    if len(locs) == 0:
-        # No car detected, try detecting plate on whole image
-        lp_net = get_lp_model()
-        lp_results = lp_net(im)
-        for rslt in lp_results.xyxy[0]:
-            x1, y1, x2, y2 = [int(x) for x in rslt[:4]]
-            plate_crop = im.crop((x1, y1, x2, y2))
-            text = recognize_plate(plate_crop)
-            if text:
-                detected_texts.append({"text": text, "box": [x1, y1, x2, y2]})
-    else:
-        # Car detected, crop car then detect plate
-        # Load LP model
-        lp_net = get_lp_model()
-        
-        for *box, conf, cls in locs:
-            x1, y1, x2, y2 = [int(x) for x in box]
-            car_crop = im.crop((x1, y1, x2, y2))
-            
-            lp_results = lp_net(car_crop)
-            for rslt in lp_results.xyxy[0]:
-                px1, py1, px2, py2 = [int(x) for x in rslt[:4]]
-                # Calculate absolute coordinates on original image
-                abs_x1 = x1 + px1
-                abs_y1 = y1 + py1
-                abs_x2 = x1 + px2
-                abs_y2 = y1 + py2
-                
-                plate_crop = car_crop.crop((px1, py1, px2, py2))
-                text = recognize_plate(plate_crop)
-                if text:
-                    detected_texts.append({"text": text, "box": [abs_x1, abs_y1, abs_x2, abs_y2]})
-    
-    # Explicit garbage collection
-    gc.collect()
-    
-    return detected_texts
+@app.get("/metrics")
+def get_metrics():
+    body, content_type = metrics.render()
+    return Response(body, media_type=content_type)
+
+# --- Inference ---
+# The ML stack (torch, PaddleOCR, OpenCV) lives in inference.py and is not
+# imported at startup, so CRUD and static serving come up in well under a
+# second. With INFERENCE_URL set, /analyze forwards images to a separate
+# inference service (uvicorn backend.inference_service:app) and this process
+# never loads it. Otherwise inference.py is imported on the first /analyze,
+# or in the background right after startup with INFERENCE_PRELOAD=1.
+INFERENCE_URL = os.environ.get("INFERENCE_URL", "").rstrip("/")
+INFERENCE_TIMEOUT = float(os.environ.get("INFERENCE_TIMEOUT", 60))
+INFERENCE_PRELOAD = os.environ.get("INFERENCE_PRELOAD", "0") == "1"
+# Alternatives below this confidence are never matched against the registry
+MATCH_MIN_CONFIDENCE = float(os.environ.get("MATCH_MIN_CONFIDENCE", 0.6))
+
+_inference_client = None
+
+def load_inference():
+    """The local pipeline module, imported on first use."""
+    return importlib.import_module(f"{__package__}.inference" if __package__ else "inference")
+
+async def infer_local(contents):
+    # The first call pays the ML import, keep it off the event loop too
+    inference = await run_in_threadpool(load_inference)
+    return await run_in_threadpool(inference.process_image, contents)
+
+async def infer_remote(contents):
+    global _inference_client
+    if _inference_client is None:
+        _inference_client = httpx.AsyncClient(base_url=INFERENCE_URL, timeout=INFERENCE_TIMEOUT)
+    response = await _inference_client.post(
+        "/infer", content=contents, headers={"Content-Type": "application/octet-stream"}
+    )
+    response.raise_for_status()
+    return response.json()["results"]
+
+@app.middleware("http")
+async def track_in_flight(request, call_next):
+    # Lets memory.py defer gc.freeze() until no request is running
+    with memory.request_scope():
+        return await call_next(request)
+
+
+# Site (apartment complex) ids: letters, digits, '-' and '_'
+SITE_PATTERN = re.compile(r'^[A-Za-z0-9_-]{1,64}$')
+
+def get_site(site: Optional[str] = None, x_site_id: Optional[str] = Header(None)):
+    """Site from ?site= or the X-Site-Id header, else DEFAULT_SITE."""
+    site = site or x_site_id or db.DEFAULT_SITE
+    if not SITE_PATTERN.match(site):
+        raise HTTPException(status_code=400, detail="Invalid site id")
+    return site
+
+async def match_registry(result, site):
+    """First of the best reading and its confident alternatives registered at the site.
+
+    Trimmed guesses (a digit the OCR read dropped) are never matched, or a
+    plate like 123가4567 would be reported as a registered 23가4567.
+    """
+    texts = [result["text"]] + [
+        alt["text"] for alt in result["alternatives"]
+        if not alt.get("trimmed") and alt["confidence"] >= MATCH_MIN_CONFIDENCE
+    ]
+    for text in texts:
+        vehicle = await db.find_vehicle_by_plate(text, site)
+        if vehicle:
+            return text, vehicle
+    return None, None
 
 @app.post("/analyze")
-async def analyze_image(file: UploadFile = File(...)):
-    print("Analyze request received")
+async def analyze_image(file: UploadFile = File(...), site: str = Depends(get_site)):
     contents = await file.read()
-    print(f"Image received, size: {len(contents)} bytes")
+    logger.info("analyze request received bytes=%d", len(contents))
     try:
-        # Run CPU-intensive task in threadpool to avoid blocking the event loop
-        from fastapi.concurrency import run_in_threadpool
-        results = await run_in_threadpool(process_image, contents)
+        # Run CPU-intensive task in threadpool (or the inference service) to avoid blocking the event loop
+        with metrics.ANALYZE_QUEUE_DEPTH.track_inprogress():
+            results = await (infer_remote(contents) if INFERENCE_URL else infer_local(contents))
         
-        print(f"Process results: {results}")
+        logger.debug("analyze results=%s", results)
         # Return the first detected result or failure
         if results:
-            return {"text": results[0]["text"], "box": results[0]["box"], "all_candidates": results}
+            best = results[0]
+            matched_text, match = await match_registry(best, site)
+            logger.info("analyze site=%s plate=%s confidence=%.3f candidates=%d matched=%s",
+                        site, best["text"], best["confidence"], len(results), matched_text)
+            return {
+                "text": best["text"],
+                "box": best["box"],
+                "confidence": best["confidence"],
+                "alternatives": best["alternatives"],
+                "all_candidates": results,
+                "match": match,
+                "matchedText": matched_text,
+            }
         else:
-            print("No text detected")
-            return {"text": "인식실패", "box": None, "all_candidates": []}
+            logger.info("analyze no plate detected")
+            return {"text": "인식실패", "box": None, "all_candidates": [], "match": None}
     except Exception as e:
-        print(f"Error: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("analyze failed: %s", e)
         return {"text": "오류발생", "error": str(e)}
 
 from fastapi.staticfiles import StaticFiles
-import os
 
 # Static file mount moved to end
 
 # --- API Endpoints ---
 from pydantic import BaseModel
-from typing import List, Optional
 try:
     import backend.database as db
+    import backend.responses as responses
+    import backend.exports as exports
 except ImportError:
     import database as db
-import pandas as pd
-from fastapi.responses import FileResponse
-import shutil
+    import responses
+    import exports
+from fastapi.responses import StreamingResponse
+from datetime import date, timedelta
+import functools
 
 class VehicleModel(BaseModel):
     plateNumber: str
@@ -232,7 +206,8 @@ class ViolationModel(BaseModel):
     reason: str
 
 class HistoryModel(BaseModel):
-    type: str # call or report
+    # Checked here: the write is queued, so a value the DB rejects would only fail later
+    type: Literal["call", "report"]
     plateNumber: str
     ownerName: str
     unitNumber: Optional[str] = ""
@@ -243,33 +218,46 @@ class HistoryModel(BaseModel):
     reporterName: Optional[str] = ""
 
 @app.get("/api/vehicles")
-def get_vehicles_api():
-    return db.get_vehicles()
+async def get_vehicles_api(request: Request, site: str = Depends(get_site)):
+    return responses.negotiate(request, await db.get_vehicles(site))
+
+@app.get("/api/vehicles/search")
+async def search_vehicles_api(q: str = "", page: int = 1, size: int = 20, site: str = Depends(get_site)):
+    page = max(page, 1)
+    size = min(max(size, 1), 100)
+    total, items = await db.search_vehicles(q, (page - 1) * size, size, site)
+    return {"total": total, "page": page, "size": size, "items": items}
 
 @app.post("/api/vehicles")
-def add_vehicle_api(vehicle: VehicleModel):
-    return db.add_vehicle(vehicle.dict())
+async def add_vehicle_api(vehicle: VehicleModel, site: str = Depends(get_site)):
+    return await db.add_vehicle(vehicle.dict(), site)
 
 @app.put("/api/vehicles/{vehicle_id}")
-def update_vehicle_api(vehicle_id: str, vehicle: VehicleUpdateModel):
-    return db.update_vehicle(vehicle_id, vehicle.dict(exclude_unset=True))
+async def update_vehicle_api(vehicle_id: str, vehicle: VehicleUpdateModel, site: str = Depends(get_site)):
+    return await db.update_vehicle(vehicle_id, vehicle.dict(exclude_unset=True), site)
 
 @app.delete("/api/vehicles/{vehicle_id}")
-def delete_vehicle_api(vehicle_id: str):
-    success = db.delete_vehicle(vehicle_id)
+async def delete_vehicle_api(vehicle_id: str, site: str = Depends(get_site)):
+    success = await db.delete_vehicle(vehicle_id, site)
     return {"success": success}
 
 @app.post("/api/vehicles/{vehicle_id}/violations")
-def add_violation_api(vehicle_id: str, violation: ViolationModel):
-    return db.add_violation(vehicle_id, violation.dict())
+async def add_violation_api(vehicle_id: str, violation: ViolationModel, idempotency_key: Optional[str] = Header(None),
+                            site: str = Depends(get_site)):
+    result = await db.add_violation(vehicle_id, violation.dict(), idempotency_key, site)
+    if result is None:
+        # Queued reports are accepted blindly otherwise, refuse them up front
+        raise HTTPException(status_code=404, detail="Vehicle not found")
+    return result
 
 @app.get("/api/history")
-def get_history_api():
-    return db.get_history()
+async def get_history_api(request: Request, site: str = Depends(get_site)):
+    return responses.negotiate(request, await db.get_history(site))
 
 @app.post("/api/history")
-def add_history_api(item: HistoryModel):
-    return db.add_history(item.dict())
+async def add_history_api(item: HistoryModel, idempotency_key: Optional[str] = Header(None),
+                          site: str = Depends(get_site)):
+    return await db.add_history(item.dict(), idempotency_key, site)
 
 # --- Image Upload ---
 import uuid
@@ -282,6 +270,8 @@ app.mount("/uploads", StaticFiles(directory=UPLOAD_DIR), name="uploads")
 
 @app.post("/api/upload")
 async def upload_image(file: UploadFile = File(...)):
+    from PIL import Image
+
     try:
         contents = await file.read()
         image = Image.open(io.BytesIO(contents))
@@ -318,62 +308,104 @@ async def upload_image(file: UploadFile = File(...)):
         }
         
     except Exception as e:
-        print(f"Image upload error: {e}")
+        logger.exception("image upload failed: %s", e)
         return {"error": str(e)}
 
 # --- Excel Upload ---
 
+XLSX_MEDIA_TYPE = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+
+@functools.lru_cache(maxsize=1)
+def template_bytes():
+    # Static content: build once, serve from memory
+    return exports.template_bytes()
+
 @app.get("/api/vehicles/template")
 def get_template():
-    # Create a sample dataframe
-    df = pd.DataFrame({
-        "차량번호": ["12가3456", "34나5678"],
-        "차주명": ["홍길동", "김철수"],
-        "동": ["101", "102"],
-        "호": ["1001", "202"],
-        "전화번호": ["010-1234-5678", "010-9876-5432"],
-        "구분": ["입주민", "직원"] # resident, staff
-    })
-    
-    file_path = "backend/template.xlsx"
-    df.to_excel(file_path, index=False)
-    return FileResponse(file_path, filename="vehicle_registration_template.xlsx")
+    return Response(
+        template_bytes(),
+        media_type=XLSX_MEDIA_TYPE,
+        headers={"Content-Disposition": 'attachment; filename="vehicle_registration_template.xlsx"'},
+    )
+
+async def export_response(columns, pages, name, format):
+    if format == "csv":
+        return StreamingResponse(
+            exports.csv_stream(columns, pages),
+            media_type="text/csv; charset=utf-8",
+            headers={"Content-Disposition": f'attachment; filename="{name}.csv"'},
+        )
+    if format != "xlsx":
+        raise HTTPException(status_code=400, detail="format must be xlsx or csv")
+    path = await exports.xlsx_file(columns, pages, name)
+    return StreamingResponse(
+        exports.file_stream(path),
+        media_type=XLSX_MEDIA_TYPE,
+        headers={"Content-Disposition": f'attachment; filename="{name}.xlsx"'},
+    )
+
+@app.get("/api/vehicles/export")
+async def export_vehicles(format: str = "xlsx", site: str = Depends(get_site)):
+    return await export_response(exports.VEHICLE_COLUMNS, db.iter_vehicles(site), "vehicles", format)
+
+@app.get("/api/history/export")
+async def export_history(format: str = "xlsx", date_from: Optional[date] = Query(None, alias="from"),
+                         date_to: Optional[date] = Query(None, alias="to"), site: str = Depends(get_site)):
+    # 'to' is inclusive for callers, exclusive upstream
+    upper = (date_to + timedelta(days=1)).isoformat() if date_to else None
+    lower = date_from.isoformat() if date_from else None
+    return await export_response(exports.HISTORY_COLUMNS, db.iter_history(site, lower, upper), "history", format)
 
 @app.post("/api/vehicles/upload")
-async def upload_vehicles(file: UploadFile = File(...), replace: bool = False):
+async def upload_vehicles(file: UploadFile = File(...), replace: bool = False, site: str = Depends(get_site)):
+    import pandas as pd
+
     contents = await file.read()
     try:
-        df = pd.read_excel(io.BytesIO(contents))
+        # dtype=str keeps 101 as "101" rather than "101.0" when a column has blanks
+        df = pd.read_excel(io.BytesIO(contents), dtype=str)
         
         # Map columns
         # Expected: 차량번호, 차주명, 동, 호, 전화번호, 구분
         # Map to: plateNumber, ownerName, dong, ho, phoneNumber, type
         
-        vehicles_to_add = []
-        
         type_map = {"입주민": "resident", "직원": "staff", "방문객": "unidentified", "미확인": "unidentified"}
         
-        for _, row in df.iterrows():
-            v_type = type_map.get(row.get("구분", "입주민"), "resident")
-            
-            vehicle = {
-                "plateNumber": str(row.get("차량번호", "")),
-                "ownerName": str(row.get("차주명", "")),
-                "dong": str(row.get("동", "")),
-                "ho": str(row.get("호", "")),
-                "phoneNumber": str(row.get("전화번호", "")),
-                "type": v_type
-            }
-            vehicles_to_add.append(vehicle)
+        def column(name):
+            # Missing columns/cells become "" instead of "nan"
+            if name not in df:
+                return pd.Series([""] * len(df), index=df.index)
+            return plates.normalize_series(df[name]) if name == "차량번호" else df[name].fillna("").astype(str).str.strip()
+        
+        columns = {
+            "plateNumber": column("차량번호"),
+            "ownerName": column("차주명"),
+            "dong": column("동"),
+            "ho": column("호"),
+            "phoneNumber": column("전화번호"),
+        }
+        types = df["구분"].map(type_map).fillna("resident") if "구분" in df else pd.Series(["resident"] * len(df), index=df.index)
+        
+        vehicles_to_add = []
+        skipped = []
+        for i in range(len(df)):
+            vehicle = {key: values.iat[i] for key, values in columns.items()}
+            vehicle["type"] = types.iat[i]
+            # A row without a plate cannot be matched by anything
+            if not vehicle["plateNumber"]:
+                skipped.append(vehicle)
+            else:
+                vehicles_to_add.append(vehicle)
             
         if replace:
-            db.delete_all_vehicles()
+            await db.delete_all_vehicles(site)
             
-        result = db.bulk_add_vehicles(vehicles_to_add)
+        result = await db.bulk_add_vehicles(vehicles_to_add, site)
+        result["failed"].extend(skipped)
         return result
         
     except Exception as e:
-        print(f"Excel upload error: {e}")
+        logger.exception("excel upload failed: %s", e)
         return {"error": str(e)}
 
 # Mount static files if dist directory exists
@@ -382,6 +414,5 @@ if os.path.exists("dist"):
     app.mount("/", StaticFiles(directory="dist", html=True), name="static")
 if __name__ == "__main__":
     import uvicorn
-    import os
     port = int(os.environ.get("PORT", 8000))
     uvicorn.run("backend.main:app", host="0.0.0.0", port=port, reload=True)
@@ -0,0 +1,175 @@
+"""Keep process RSS within a configured budget without collecting on the request path.
+
+A daemon thread samples RSS every MEMORY_CHECK_INTERVAL seconds. Above the
+soft limit it runs a full gc.collect() and returns freed heap pages to the OS
+(glibc malloc_trim); once a collection frees less than MEMORY_MIN_FREED_MB it
+is not repeated until RSS grows again, since loaded models alone can hold RSS
+there. If RSS is still above MEMORY_BUDGET_MB and no request is in flight the
+registered unload hooks run (e.g. dropping idle models). Freezing freshly
+loaded models out of gc is deferred until no request is in flight.
+"""
+import contextlib
+import ctypes
+import ctypes.util
+import gc
+import logging
+import os
+import threading
+import time
+
+try:
+    import backend.metrics as metrics
+except ImportError:
+    import metrics
+
+logger = logging.getLogger(__name__)
+
+MEMORY_BUDGET_MB = int(os.environ.get("MEMORY_BUDGET_MB", 512))
+# Collect once RSS passes this fraction of the budget
+MEMORY_SOFT_LIMIT = float(os.environ.get("MEMORY_SOFT_LIMIT", 0.85))
+MEMORY_CHECK_INTERVAL = float(os.environ.get("MEMORY_CHECK_INTERVAL", 30))
+# Unload models when collection alone cannot get back under budget
+MEMORY_UNLOAD_ON_PRESSURE = os.environ.get("MEMORY_UNLOAD_ON_PRESSURE", "0") == "1"
+# A collection freeing less than this counts as futile; skip until RSS grows by as much
+MEMORY_MIN_FREED_MB = float(os.environ.get("MEMORY_MIN_FREED_MB", 8))
+
+_PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+_unload_hooks = []
+_in_flight = 0
+_in_flight_lock = threading.Lock()
+_freeze_pending = threading.Event()
+# RSS after the last collection that freed next to nothing
+_futile_rss = None
+_thread = None
+_stop = threading.Event()
+
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6")
+    _malloc_trim = _libc.malloc_trim
+except (OSError, AttributeError):
+    # Not glibc (macOS, musl); freed memory stays in the allocator
+    _malloc_trim = None
+
+def rss_bytes():
+    """Current resident set size of this process."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * _PAGE_SIZE
+    except OSError:
+        # Fall back to peak RSS where /proc is unavailable
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def budget_bytes():
+    return MEMORY_BUDGET_MB * 1024 * 1024
+
+def register_unload_hook(hook):
+    """Register a callable run when RSS stays above budget after collection.
+
+    The hook releases its own memory and returns how many things it unloaded.
+    """
+    _unload_hooks.append(hook)
+
+def freeze_long_lived():
+    """Move objects alive now (loaded models) out of future gc generations.
+
+    Runs a full collection, so prefer request_freeze() from code that may be
+    on the request path.
+    """
+    gc.collect()
+    gc.freeze()
+
+@contextlib.contextmanager
+def request_scope():
+    """Mark a request in flight; pending freezes wait until none is."""
+    global _in_flight
+    with _in_flight_lock:
+        _in_flight += 1
+    try:
+        yield
+    finally:
+        with _in_flight_lock:
+            _in_flight -= 1
+            idle = _in_flight == 0
+        if idle and _freeze_pending.is_set():
+            threading.Thread(target=freeze_if_idle, name="gc-freeze", daemon=True).start()
+
+def in_flight():
+    """Number of requests currently in flight."""
+    with _in_flight_lock:
+        return _in_flight
+
+def request_freeze():
+    """Ask for freeze_long_lived() at the next moment no request is in flight.
+
+    Called after a model load: freezing inside the loading request would stall
+    it and pin other in-flight requests' objects until the next unfreeze.
+    """
+    _freeze_pending.set()
+    freeze_if_idle()
+
+def freeze_if_idle():
+    """Run a pending freeze if no request is in flight; True if it ran."""
+    with _in_flight_lock:
+        if _in_flight or not _freeze_pending.is_set():
+            return False
+        _freeze_pending.clear()
+    freeze_long_lived()
+    return True
+
+def collect(reason):
+    """Full collection plus malloc_trim, timed into gc_pause_seconds."""
+    start = time.perf_counter()
+    gc.collect()
+    if _malloc_trim is not None:
+        _malloc_trim(0)
+    metrics.GC_PAUSE_SECONDS.labels(reason).observe(time.perf_counter() - start)
+    metrics.GC_COLLECTIONS_TOTAL.labels(reason).inc()
+
+def check():
+    """One budget check; returns RSS after any action taken."""
+    global _futile_rss
+    rss = rss_bytes()
+    if rss < budget_bytes() * MEMORY_SOFT_LIMIT:
+        _futile_rss = None
+        return rss
+
+    min_freed = MEMORY_MIN_FREED_MB * 1024 * 1024
+    if _futile_rss is None or rss > _futile_rss + min_freed:
+        before = rss
+        collect("soft_limit")
+        rss = rss_bytes()
+        _futile_rss = rss if before - rss < min_freed else None
+
+    if rss > budget_bytes() and MEMORY_UNLOAD_ON_PRESSURE and _unload_hooks:
+        # Never pull a model out from under a running request
+        if in_flight():
+            return rss
+        unloaded = sum(hook() or 0 for hook in _unload_hooks)
+        if unloaded:
+            logger.warning("memory over budget rss_mb=%d budget_mb=%d, unloaded=%d",
+                           rss // 2**20, MEMORY_BUDGET_MB, unloaded)
+            _futile_rss = None
+            rss = rss_bytes()
+    return rss
+
+def _run():
+    while not _stop.wait(MEMORY_CHECK_INTERVAL):
+        try:
+            # Catch up on a freeze the request traffic kept deferring
+            freeze_if_idle()
+            check()
+        except Exception as e:
+            logger.exception("memory check failed: %s", e)
+
+def start():
+    """Start the background budget thread (idempotent)."""
+    global _thread
+    metrics.MEMORY_BUDGET_BYTES.set(budget_bytes())
+    if _thread is None or not _thread.is_alive():
+        _stop.clear()
+        _thread = threading.Thread(target=_run, name="memory-budget", daemon=True)
+        _thread.start()
+
+def stop():
+    _stop.set()
@@ -0,0 +1,157 @@
+from prometheus_client import Counter, Gauge, Histogram, CONTENT_TYPE_LATEST, generate_latest
+
+# Process RSS, CPU time and open fds are exported by prometheus_client's default
+# process collector (process_resident_memory_bytes etc.) on Linux.
+
+# Latency buckets tuned for CPU inference on small instances (seconds)
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+# Supabase round trips are network bound, so start lower
+DB_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+# --- Recognition pipeline ---
+
+PIPELINE_STAGE_SECONDS = Histogram(
+    "pipeline_stage_seconds",
+    "Time spent in each /analyze pipeline stage",
+    ["stage"],  # decode, car_detection, plate_detection, tile_detection, ocr, total
+    buckets=LATENCY_BUCKETS,
+)
+
+ANALYZE_QUEUE_DEPTH = Gauge(
+    "analyze_queue_depth",
+    "/analyze requests waiting for or running in the threadpool",
+)
+
+PLATES_DETECTED_TOTAL = Counter(
+    "plates_detected_total",
+    "Plates recognized by /analyze",
+)
+
+PYRAMID_TILES_TOTAL = Counter(
+    "pyramid_tiles_total",
+    "High-resolution tiles run by the adaptive pyramid",
+    ["reason"],  # small_plate (coarse plate below PLATE_MIN_PIXELS), no_plate (car without a coarse plate)
+)
+
+# --- OCR cascade ---
+
+OCR_STAGE_SECONDS = Histogram(
+    "ocr_stage_seconds",
+    "Time spent in each OCR cascade stage",
+    ["stage"],  # rec_only, full
+    buckets=LATENCY_BUCKETS,
+)
+
+OCR_CASCADE_TOTAL = Counter(
+    "ocr_cascade_total",
+    "Plate crops by cascade outcome",
+    ["outcome"],  # accepted (rec_only result used), fallback (full PaddleOCR run)
+)
+
+# --- Models ---
+
+MODEL_LOAD_SECONDS = Gauge(
+    "model_load_seconds",
+    "Duration of the most recent load of each model",
+    ["model"],  # car, lp, ocr
+)
+
+MODEL_CACHE_TOTAL = Counter(
+    "model_cache_total",
+    "Model lookups served from memory (hit) or requiring a load (miss)",
+    ["model", "result"],
+)
+
+MODEL_EVENTS_TOTAL = Counter(
+    "model_events_total",
+    "Model lifecycle events",
+    ["model", "event"],  # load, evict, reload, preload
+)
+
+MODEL_LOADED = Gauge(
+    "model_loaded",
+    "1 if the model is resident in memory",
+    ["model"],
+)
+
+# --- Database ---
+
+DB_OPERATION_SECONDS = Histogram(
+    "db_operation_seconds",
+    "Latency of database.py operations",
+    ["operation"],
+    buckets=DB_BUCKETS,
+)
+
+DB_ERRORS_TOTAL = Counter(
+    "db_errors_total",
+    "database.py operations that raised",
+    ["operation"],
+)
+
+DB_RETRIES_TOTAL = Counter(
+    "db_retries_total",
+    "Supabase requests retried after a transient failure",
+    ["table"],
+)
+
+DB_COALESCED_TOTAL = Counter(
+    "db_coalesced_total",
+    "Reads served by joining an identical in-flight request",
+    ["table"],
+)
+
+WRITE_QUEUE_DEPTH = Gauge(
+    "write_queue_depth",
+    "Writes waiting in the local write-ahead queue",
+)
+
+WRITE_QUEUE_FLUSHED_TOTAL = Counter(
+    "write_queue_flushed_total",
+    "Queued writes confirmed upstream",
+    ["operation"],
+)
+
+WRITE_QUEUE_DEAD_TOTAL = Counter(
+    "write_queue_dead_total",
+    "Queued writes moved to dead_writes (rejected upstream or out of attempts)",
+    ["operation"],
+)
+
+# --- Caches ---
+
+CACHE_REQUESTS_TOTAL = Counter(
+    "cache_requests_total",
+    "Read-through cache lookups by result",
+    ["cache", "result"],  # hit, stale, stale_on_error, miss
+)
+
+CACHE_INVALIDATIONS_TOTAL = Counter(
+    "cache_invalidations_total",
+    "Cache invalidations caused by writes",
+    ["cache"],
+)
+
+# --- Memory ---
+
+MEMORY_BUDGET_BYTES = Gauge(
+    "memory_budget_bytes",
+    "Configured RSS budget (MEMORY_BUDGET_MB)",
+)
+
+GC_COLLECTIONS_TOTAL = Counter(
+    "gc_collections_total",
+    "Full collections run by the memory manager",
+    ["reason"],  # soft_limit, evict
+)
+
+GC_PAUSE_SECONDS = Histogram(
+    "gc_pause_seconds",
+    "Duration of memory manager collections (off the request path)",
+    ["reason"],
+    buckets=LATENCY_BUCKETS,
+)
+
+def render():
+    """Return (body, content_type) for the /metrics endpoint."""
+    return generate_latest(), CONTENT_TYPE_LATEST
@@ -0,0 +1,171 @@
+"""Model lifecycle: lazy load, idle eviction, background reload and scheduled preload.
+
+Models are registered with a loader function and fetched with get(). A daemon
+thread evicts models unused for MODEL_IDLE_TTL seconds and preloads all models
+at the local times listed in MODEL_PRELOAD_AT (e.g. "06:30,14:30,22:30") so
+they are warm before a shift change. When a request needs an evicted model,
+the other evicted models are reloaded in the background.
+"""
+import gc
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+
+try:
+    import backend.metrics as metrics
+    import backend.memory as memory
+except ImportError:
+    import metrics
+    import memory
+
+logger = logging.getLogger(__name__)
+
+# Seconds without use before a model is evicted (0 disables eviction)
+MODEL_IDLE_TTL = float(os.environ.get("MODEL_IDLE_TTL", 1800))
+MODEL_CHECK_INTERVAL = float(os.environ.get("MODEL_CHECK_INTERVAL", 60))
+# Under memory pressure, only models unused for this many seconds are unloaded
+MODEL_PRESSURE_IDLE = float(os.environ.get("MODEL_PRESSURE_IDLE", 60))
+MODEL_PRELOAD_AT = os.environ.get("MODEL_PRELOAD_AT", "")
+
+def parse_schedule(spec):
+    """Parse "HH:MM,HH:MM" into [(hour, minute)]."""
+    times = []
+    for item in spec.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        hour, minute = item.split(":")
+        times.append((int(hour), int(minute)))
+    return times
+
+class ModelManager:
+    def __init__(self, idle_ttl=MODEL_IDLE_TTL, check_interval=MODEL_CHECK_INTERVAL, preload_at=MODEL_PRELOAD_AT):
+        self.idle_ttl = idle_ttl
+        self.check_interval = check_interval
+        self.preload_at = parse_schedule(preload_at)
+        self._loaders = {}
+        self._models = {}
+        self._last_used = {}
+        self._locks = {}
+        self._evicted = set()
+        self._thread = None
+        self._stop = threading.Event()
+        self._last_check = datetime.now()
+
+    def register(self, name, loader):
+        self._loaders[name] = loader
+        self._locks[name] = threading.Lock()
+        metrics.MODEL_LOADED.labels(name).set(0)
+
+    def get(self, name):
+        """Return the model, loading it on first use or after eviction."""
+        model = self._models.get(name)
+        if model is not None:
+            self._last_used[name] = time.monotonic()
+            metrics.MODEL_CACHE_TOTAL.labels(name, "hit").inc()
+            return model
+
+        metrics.MODEL_CACHE_TOTAL.labels(name, "miss").inc()
+        if name in self._evicted:
+            # Traffic is back; warm the other evicted models while this one loads
+            others = [n for n in self._evicted if n != name]
+            if others:
+                threading.Thread(target=self.preload, args=(others, "reload"), daemon=True).start()
+        return self._load(name, "reload" if name in self._evicted else "load")
+
+    def _load(self, name, event):
+        with self._locks[name]:
+            # Another thread may have loaded it while we waited
+            model = self._models.get(name)
+            if model is None:
+                logger.info("model loading model=%s event=%s", name, event)
+                start = time.perf_counter()
+                model = self._loaders[name]()
+                metrics.MODEL_LOAD_SECONDS.labels(name).set(time.perf_counter() - start)
+                metrics.MODEL_EVENTS_TOTAL.labels(name, event).inc()
+                metrics.MODEL_LOADED.labels(name).set(1)
+                self._models[name] = model
+                self._evicted.discard(name)
+                # Deferred to a moment with no request in flight
+                memory.request_freeze()
+            self._last_used[name] = time.monotonic()
+            return model
+
+    def preload(self, names=None, event="preload"):
+        for name in names or list(self._loaders):
+            if name not in self._models:
+                try:
+                    self._load(name, event)
+                except Exception as e:
+                    logger.exception("model preload failed model=%s: %s", name, e)
+
+    def evict(self, name):
+        """Unload a model; True if it was loaded."""
+        with self._locks[name]:
+            if self._models.pop(name, None) is None:
+                return False
+            self._evicted.add(name)
+        metrics.MODEL_EVENTS_TOTAL.labels(name, "evict").inc()
+        metrics.MODEL_LOADED.labels(name).set(0)
+        logger.info("model evicted model=%s", name)
+        # Frozen objects are never collected, let the model go
+        gc.unfreeze()
+        memory.collect("evict")
+        # unfreeze() released the resident models too; freeze them again
+        memory.request_freeze()
+        return True
+
+    def evict_all(self):
+        for name in list(self._models):
+            self.evict(name)
+
+    def evict_idle(self, idle_ttl=None):
+        """Evict models unused for idle_ttl seconds (default self.idle_ttl); returns the count."""
+        idle_ttl = self.idle_ttl if idle_ttl is None else idle_ttl
+        if idle_ttl <= 0:
+            return 0
+        now = time.monotonic()
+        return sum(
+            self.evict(name) for name in list(self._models)
+            if now - self._last_used.get(name, now) > idle_ttl
+        )
+
+    def evict_for_pressure(self):
+        """memory.py unload hook: drop only models not used in the last MODEL_PRESSURE_IDLE seconds."""
+        return self.evict_idle(MODEL_PRESSURE_IDLE)
+
+    def _preload_due(self, now):
+        """True if a scheduled preload time fell between the last check and now."""
+        for hour, minute in self.preload_at:
+            due = now.replace(hour=hour, minute=minute, second=0, microsecond=0)
+            if due > now:
+                due -= timedelta(days=1)
+            if self._last_check < due <= now:
+                return True
+        return False
+
+    def _run(self):
+        while not self._stop.wait(self.check_interval):
+            try:
+                now = datetime.now()
+                if self._preload_due(now):
+                    self.preload()
+                self._last_check = now
+                self.evict_idle()
+            except Exception as e:
+                logger.exception("model manager check failed: %s", e)
+
+    def start(self):
+        """Start the eviction/preload thread (idempotent)."""
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._last_check = datetime.now()
+            self._thread = threading.Thread(target=self._run, name="model-manager", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+manager = ModelManager()
@@ -0,0 +1,75 @@
+"""Korean licence plate normalization shared by OCR, Excel import, search and lookup.
+
+normalize() folds full-width characters to ASCII (NFKC, which also leaves
+Hangul composed as in NFC), drops separators and maps empty/NaN values to "".
+canonical_key() is what every index and lookup compares: the plate core
+(e.g. "12가3456") when one is present, otherwise the normalized text. Batch
+variants work on lists and, vectorized, on pandas Series.
+"""
+import re
+import unicodedata
+
+# License Plate Character whitelist - Official Korean LP characters
+VALID_KOREAN = '가나다라마거너더러머버서어저고노도로모보소오조구누두루무부수우주아바사자배하허호'
+# Regex to capture patterns like 12가3456 or 123가4567
+# Allow some noise but look for the structure
+PLATE_PATTERN = re.compile(r'([0-9]{2,3})[' + VALID_KOREAN + r']([0-9]{4})')
+
+# Plate formats
+OLD = "old"          # 2-digit prefix, e.g. 12가3456
+NEW = "new"          # 3-digit prefix (2019+), e.g. 123가4567
+INVALID = "invalid"
+
+_SEPARATORS = re.compile(r'[\s\-_.·]+')
+# Values pandas/str() produce for missing cells
+_MISSING = {"", "nan", "none", "null", "<na>"}
+
+def normalize(text):
+    """NFKC-fold, strip separators; None/NaN become ""."""
+    if text is None:
+        return ""
+    text = str(text)
+    if text.strip().lower() in _MISSING:
+        return ""
+    return _SEPARATORS.sub("", unicodedata.normalize("NFKC", text))
+
+def classify(text):
+    """OLD, NEW or INVALID for an already-normalized plate."""
+    match = PLATE_PATTERN.fullmatch(text)
+    if match is None:
+        return INVALID
+    return NEW if len(match.group(1)) == 3 else OLD
+
+def canonical_key(text):
+    """Key used by every index, import and lookup path."""
+    text = normalize(text)
+    match = PLATE_PATTERN.search(text)
+    # Drop region prefixes and stray characters around the plate core
+    return match.group(0) if match else text
+
+# --- Batch APIs ---
+
+def normalize_many(texts):
+    return [normalize(text) for text in texts]
+
+def canonical_keys(texts):
+    return [canonical_key(text) for text in texts]
+
+def normalize_series(series):
+    """Vectorized normalize() over a pandas Series; returns a str Series."""
+    text = series.astype("string").str.normalize("NFKC")
+    text = text.str.replace(_SEPARATORS.pattern, "", regex=True)
+    missing = text.isna() | text.str.lower().isin(_MISSING)
+    return text.mask(missing, "").astype(str)
+
+def canonical_key_series(series):
+    """Vectorized canonical_key() over a pandas Series."""
+    text = normalize_series(series)
+    core = text.str.extract('(' + PLATE_PATTERN.pattern + ')', expand=True)[0]
+    return core.fillna(text)
+
+def classify_series(series):
+    """Vectorized classify() over a Series of normalized plates."""
+    parts = series.str.extract('^' + PLATE_PATTERN.pattern + '$', expand=True)
+    result = parts[0].str.len().map({2: OLD, 3: NEW})
+    return result.fillna(INVALID)
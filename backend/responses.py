@@ -0,0 +1,97 @@
+"""Content negotiation for large list endpoints.
+
+Clients choose a representation with the Accept header or ?format=:
+
+    application/json                         rows as objects (default)
+    application/vnd.parking.columns+json     {"length": n, "columns": {key: [values]}}
+    application/msgpack                      rows, MessagePack
+    application/vnd.parking.columns+msgpack  columns, MessagePack
+
+Bodies are encoded with orjson and compressed with brotli or gzip according
+to Accept-Encoding. msgpack and brotli are optional; without them the JSON
+and gzip variants are used.
+"""
+import gzip
+
+import orjson
+from fastapi import Response
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+JSON = "application/json"
+COLUMNS_JSON = "application/vnd.parking.columns+json"
+MSGPACK = "application/msgpack"
+COLUMNS_MSGPACK = "application/vnd.parking.columns+msgpack"
+
+FORMAT_ALIASES = {
+    "json": JSON,
+    "columns": COLUMNS_JSON,
+    "msgpack": MSGPACK,
+    "columns-msgpack": COLUMNS_MSGPACK,
+}
+
+# Below this size compression costs more than it saves
+MIN_COMPRESS_SIZE = 1024
+# Favour speed: these endpoints are hit by every device at shift start
+BROTLI_QUALITY = 4
+GZIP_LEVEL = 5
+
+def to_columns(rows):
+    """Column-oriented form of a list of dicts; keys are stored once."""
+    keys = []
+    seen = set()
+    for row in rows:
+        for key in row:
+            if key not in seen:
+                seen.add(key)
+                keys.append(key)
+    return {"length": len(rows), "columns": {key: [row.get(key) for row in rows] for key in keys}}
+
+def choose_media_type(request):
+    fmt = request.query_params.get("format")
+    if fmt in FORMAT_ALIASES:
+        media_type = FORMAT_ALIASES[fmt]
+    else:
+        accept = request.headers.get("accept", "")
+        media_type = JSON
+        # Most specific first: the columns types contain the plain subtype names
+        for candidate in (COLUMNS_MSGPACK, COLUMNS_JSON, MSGPACK):
+            if candidate in accept:
+                media_type = candidate
+                break
+    if msgpack is None and media_type in (MSGPACK, COLUMNS_MSGPACK):
+        media_type = COLUMNS_JSON if media_type == COLUMNS_MSGPACK else JSON
+    return media_type
+
+def encode(rows, media_type):
+    data = to_columns(rows) if media_type in (COLUMNS_JSON, COLUMNS_MSGPACK) else rows
+    if media_type in (MSGPACK, COLUMNS_MSGPACK):
+        return msgpack.packb(data, use_bin_type=True)
+    return orjson.dumps(data)
+
+def compress(body, accept_encoding):
+    """Return (body, content-encoding or None)."""
+    if len(body) < MIN_COMPRESS_SIZE:
+        return body, None
+    if brotli is not None and "br" in accept_encoding:
+        return brotli.compress(body, quality=BROTLI_QUALITY), "br"
+    if "gzip" in accept_encoding:
+        return gzip.compress(body, compresslevel=GZIP_LEVEL), "gzip"
+    return body, None
+
+def negotiate(request, rows):
+    """Encode rows in the representation the client asked for."""
+    media_type = choose_media_type(request)
+    body, encoding = compress(encode(rows, media_type), request.headers.get("accept-encoding", ""))
+    headers = {"Vary": "Accept, Accept-Encoding"}
+    if encoding:
+        headers["Content-Encoding"] = encoding
+    return Response(body, media_type=media_type, headers=headers)
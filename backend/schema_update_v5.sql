@@ -0,0 +1,9 @@
+-- Multi-site support: every vehicle and history row belongs to one site (apartment complex)
+
+-- 1. Add the site key; existing rows become the 'default' site
+alter table vehicles add column if not exists site text not null default 'default';
+alter table history add column if not exists site text not null default 'default';
+
+-- 2. Every query filters by site, so index it
+create index if not exists vehicles_site_idx on vehicles (site);
+create index if not exists history_site_timestamp_idx on history (site, timestamp desc);
@@ -0,0 +1,161 @@
+"""In-memory n-gram index for vehicle search.
+
+Every searchable field (plate, plate digits, owner name, dong, ho, dong-ho)
+is split into unigrams and bigrams. A query is answered by intersecting the
+posting sets of its grams and confirming the substring on the survivors, so
+cost scales with the number of matches, not the registry size. Results are
+ranked the way guards search: last 4 plate digits first, then plate prefix,
+then any other substring match.
+"""
+import re
+import time
+import threading
+
+try:
+    import backend.plates as plates
+except ImportError:
+    import plates
+
+_NON_DIGIT = re.compile(r"[^0-9]")
+
+def normalize(text):
+    return plates.normalize(text).lower()
+
+def grams(text):
+    """Unigrams and bigrams of text."""
+    result = set(text)
+    result.update(text[i:i + 2] for i in range(len(text) - 1))
+    return result
+
+def query_grams(query):
+    # Bigrams are selective enough; unigrams only for 1-character queries
+    if len(query) == 1:
+        return {query}
+    return {query[i:i + 2] for i in range(len(query) - 1)}
+
+class VehicleIndex:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._docs = {}      # id -> vehicle
+        self._fields = {}    # id -> {field: normalized text}
+        self._postings = {}  # gram -> set(id)
+        self._by_plate = {}  # plates.canonical_key -> id
+        self.built = False
+        self.built_at = 0.0
+
+    @staticmethod
+    def _fields_for(vehicle):
+        plate = normalize(vehicle.get("plateNumber"))
+        dong = normalize(vehicle.get("dong"))
+        ho = normalize(vehicle.get("ho"))
+        return {
+            "key": plates.canonical_key(plate),
+            "plate": plate,
+            "digits": _NON_DIGIT.sub("", plate),
+            "owner": normalize(vehicle.get("ownerName")),
+            "dong": dong,
+            "ho": ho,
+            "unit": f"{dong}{ho}",
+        }
+
+    def _add(self, vehicle):
+        vehicle_id = vehicle.get("id")
+        fields = self._fields_for(vehicle)
+        self._docs[vehicle_id] = vehicle
+        self._fields[vehicle_id] = fields
+        self._by_plate[fields["key"]] = vehicle_id
+        for text in fields.values():
+            for gram in grams(text):
+                self._postings.setdefault(gram, set()).add(vehicle_id)
+
+    def _remove(self, vehicle_id):
+        fields = self._fields.pop(vehicle_id, None)
+        self._docs.pop(vehicle_id, None)
+        if fields is None:
+            return
+        if self._by_plate.get(fields["key"]) == vehicle_id:
+            del self._by_plate[fields["key"]]
+        for text in fields.values():
+            for gram in grams(text):
+                ids = self._postings.get(gram)
+                if ids is not None:
+                    ids.discard(vehicle_id)
+                    if not ids:
+                        del self._postings[gram]
+
+    def build(self, vehicles):
+        with self._lock:
+            self._docs.clear()
+            self._fields.clear()
+            self._postings.clear()
+            self._by_plate.clear()
+            for vehicle in vehicles:
+                self._add(vehicle)
+            self.built = True
+            self.built_at = time.monotonic()
+
+    def upsert(self, vehicle):
+        with self._lock:
+            self._remove(vehicle.get("id"))
+            self._add(vehicle)
+
+    def remove(self, vehicle_id):
+        with self._lock:
+            self._remove(vehicle_id)
+
+    def clear(self):
+        self.build([])
+
+    def get(self, vehicle_id):
+        with self._lock:
+            return self._docs.get(vehicle_id)
+
+    def lookup_plate(self, plate):
+        """Vehicle whose plate has the same canonical key, or None."""
+        with self._lock:
+            vehicle_id = self._by_plate.get(plates.canonical_key(plate))
+            return self._docs.get(vehicle_id) if vehicle_id is not None else None
+
+    def __len__(self):
+        return len(self._docs)
+
+    @staticmethod
+    def _rank(fields, query, digits_query):
+        if digits_query and len(digits_query) == 4 and fields["digits"].endswith(digits_query):
+            return 0
+        if fields["plate"].startswith(query) or (digits_query and fields["digits"].startswith(digits_query)):
+            return 1
+        if query in fields["plate"] or (digits_query and digits_query in fields["digits"]):
+            return 2
+        if query in fields["owner"]:
+            return 3
+        if query in fields["unit"] or query in fields["dong"] or query in fields["ho"]:
+            return 4
+        return None
+
+    def search(self, query, offset=0, limit=20):
+        """Return (total, vehicles) for the page starting at offset."""
+        query = normalize(query)
+        if not query:
+            return 0, []
+        digits_query = query if query.isdigit() else ""
+
+        with self._lock:
+            candidates = None
+            for gram in query_grams(query):
+                ids = self._postings.get(gram)
+                if not ids:
+                    return 0, []
+                candidates = set(ids) if candidates is None else candidates & ids
+                if not candidates:
+                    return 0, []
+
+            ranked = []
+            for vehicle_id in candidates:
+                fields = self._fields[vehicle_id]
+                rank = self._rank(fields, query, digits_query)
+                if rank is not None:
+                    ranked.append((rank, fields["plate"], vehicle_id))
+            ranked.sort()
+            page = [self._docs[vehicle_id] for _, _, vehicle_id in ranked[offset:offset + limit]]
+        return len(ranked), page
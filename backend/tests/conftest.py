@@ -0,0 +1,7 @@
+"""Import the backend as a package and keep its write queue out of the tree."""
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+os.environ.setdefault("WRITE_QUEUE_PATH", os.path.join(tempfile.mkdtemp(), "write_queue.db"))
@@ -0,0 +1,253 @@
+"""Supabase client and write queue against an in-process httpx.MockTransport."""
+import asyncio
+import json
+
+import httpx
+import pytest
+
+import backend.database as db
+from backend.write_queue import WriteQueue
+
+class Upstream:
+    """Records requests and answers them with handler(request); GETs can be held back."""
+
+    def __init__(self, handler, get_delay=0.0):
+        self.handler = handler
+        self.get_delay = get_delay
+        self.requests = []
+
+    async def __call__(self, request):
+        self.requests.append(request)
+        # Answer as of arrival, like a database snapshot, and deliver it later
+        response = self.handler(request)
+        if request.method == "GET" and self.get_delay:
+            await asyncio.sleep(self.get_delay)
+        return response
+
+    def count(self, method):
+        return sum(1 for r in self.requests if r.method == method)
+
+@pytest.fixture(autouse=True)
+def isolated(tmp_path, monkeypatch):
+    monkeypatch.setattr(db, "write_queue", WriteQueue(str(tmp_path / "write_queue.db")))
+    monkeypatch.setattr(db, "_failures", 0)
+    monkeypatch.setattr(db, "_retry_at", 0.0)
+    monkeypatch.setattr(db, "supabase", None)
+    db.vehicles_cache.invalidate()
+    db.history_cache.invalidate()
+    yield
+    db.write_queue.close()
+
+def connect(handler, get_delay=0.0):
+    upstream = Upstream(handler, get_delay)
+    db.configure("http://mock", "key", transport=httpx.MockTransport(upstream), backoff=0)
+    return upstream
+
+def run(coro):
+    async def main():
+        try:
+            return await coro
+        finally:
+            await db.supabase.close()
+    return asyncio.run(main())
+
+# --- Coalescing ---
+
+def test_identical_reads_share_one_request():
+    upstream = connect(lambda r: httpx.Response(200, json=[{"id": "a"}]), get_delay=0.05)
+
+    async def reads():
+        return await asyncio.gather(*(db.supabase.select("vehicles", {"site": "eq.s1"}) for _ in range(5)))
+
+    assert run(reads()) == [[{"id": "a"}]] * 5
+    assert upstream.count("GET") == 1
+
+def test_different_reads_are_not_shared():
+    upstream = connect(lambda r: httpx.Response(200, json=[]), get_delay=0.05)
+
+    async def reads():
+        await asyncio.gather(db.supabase.select("vehicles", {"site": "eq.s1"}),
+                             db.supabase.select("vehicles", {"site": "eq.s2"}))
+
+    run(reads())
+    assert upstream.count("GET") == 2
+
+def test_read_after_write_does_not_join_an_older_read():
+    rows = []
+
+    def handler(request):
+        if request.method == "POST":
+            rows.append(json.loads(request.content))
+            return httpx.Response(201, json=[rows[-1]])
+        return httpx.Response(200, json=list(rows))
+
+    connect(handler, get_delay=0.1)
+
+    async def scenario():
+        # The first GET reads before the write lands and answers after it
+        first = asyncio.create_task(db.get_vehicles("s1"))
+        await asyncio.sleep(0.01)
+        await db.add_vehicle({"plateNumber": "12가3456"}, "s1")
+        second = await db.get_vehicles("s1")
+        return await first, second
+
+    first, second = run(scenario())
+    assert (len(first), len(second)) == (0, 1)
+
+def test_cancelled_leader_hands_over_to_followers():
+    upstream = connect(lambda r: httpx.Response(200, json=[{"id": "a"}]), get_delay=0.1)
+
+    async def scenario():
+        leader = asyncio.create_task(db.supabase.select("vehicles", {"site": "eq.s1"}))
+        await asyncio.sleep(0.01)
+        follower = asyncio.create_task(db.supabase.select("vehicles", {"site": "eq.s1"}))
+        await asyncio.sleep(0.01)
+        leader.cancel()
+        return await follower
+
+    assert run(scenario()) == [{"id": "a"}]
+    assert upstream.count("GET") == 2
+
+# --- Retries ---
+
+def flaky(status, fail_times, ok=201):
+    """Handler failing fail_times requests (with status, or a ConnectError if None), then answering ok."""
+    calls = []
+
+    def handler(request):
+        calls.append(request)
+        if len(calls) <= fail_times:
+            if status is None:
+                raise httpx.ConnectError("refused", request=request)
+            return httpx.Response(status)
+        return httpx.Response(ok, json=[])
+    return handler
+
+def test_post_is_not_retried_after_a_server_error():
+    upstream = connect(flaky(503, 1))
+    with pytest.raises(httpx.HTTPStatusError):
+        run(db.supabase.request("POST", "history", json={}))
+    assert upstream.count("POST") == 1
+
+def test_post_is_retried_when_it_never_reached_the_server():
+    upstream = connect(flaky(None, 1))
+    assert run(db.supabase.request("POST", "history", json={})) == []
+    assert upstream.count("POST") == 2
+
+def test_post_is_retried_on_429():
+    upstream = connect(flaky(429, 2))
+    run(db.supabase.request("POST", "history", json={}))
+    assert upstream.count("POST") == 3
+
+def test_idempotent_post_is_retried_after_a_server_error():
+    upstream = connect(flaky(503, 1))
+    run(db.supabase.request("POST", "history", json={}, idempotent=True))
+    assert upstream.count("POST") == 2
+
+def test_get_is_retried_until_max_retries():
+    upstream = connect(flaky(503, 10, ok=200))
+    with pytest.raises(httpx.HTTPStatusError):
+        run(db.supabase.request("GET", "vehicles"))
+    assert upstream.count("GET") == db.DB_MAX_RETRIES + 1
+
+# --- Write queue ---
+
+class History:
+    """Upstream history table that can be taken down or made to reject plates."""
+
+    def __init__(self):
+        self.rows = {}
+        self.down = False
+        self.rejected = set()
+
+    def __call__(self, request):
+        if request.method != "POST":
+            return httpx.Response(200, json=[])
+        if self.down:
+            raise httpx.ConnectError("refused", request=request)
+        rows = json.loads(request.content)
+        if any(row["plateNumber"] in self.rejected for row in rows):
+            return httpx.Response(400, json={"message": "bad row"})
+        self.rows.update((row["id"], row) for row in rows)
+        return httpx.Response(201)
+
+def report(plate):
+    return db.add_history({"type": "call", "plateNumber": plate, "ownerName": "x"}, site="s1")
+
+def test_outage_keeps_writes_queued():
+    history = History()
+    history.down = True
+    connect(history)
+
+    async def scenario():
+        for plate in ("1", "2", "3"):
+            await report(plate)
+        return await db.flush_pending_writes()
+
+    assert run(scenario()) == 0
+    assert db.write_queue.depth() == 3
+    assert db.write_queue.dead() == []
+    assert db.backing_off()
+
+def test_outage_backoff_grows_and_never_dead_letters():
+    history = History()
+    history.down = True
+    connect(history)
+
+    async def scenario():
+        await report("1")
+        delays = []
+        for _ in range(8):
+            db._retry_at = 0.0
+            await db.flush_pending_writes()
+            delays.append(db._retry_at - db.time.monotonic())
+        return delays
+
+    delays = run(scenario())
+    assert delays[1] > delays[0]
+    assert max(delays) <= db.WRITE_QUEUE_RETRY_INTERVAL
+    assert db.write_queue.depth() == 1
+    assert db.write_queue.dead() == []
+
+def test_recovery_flushes_the_queue():
+    history = History()
+    history.down = True
+    connect(history)
+
+    async def scenario():
+        for plate in ("1", "2"):
+            await report(plate)
+        await db.flush_pending_writes()
+        history.down = False
+        db._retry_at = 0.0
+        return await db.flush_pending_writes()
+
+    assert run(scenario()) == 2
+    assert len(history.rows) == 2
+    assert db.write_queue.depth() == 0
+    assert not db.backing_off()
+
+def test_rejected_row_is_dead_lettered_alone():
+    history = History()
+    history.rejected.add("bad")
+    connect(history)
+
+    async def scenario():
+        for plate in ("1", "bad", "2"):
+            await report(plate)
+        return await db.flush_pending_writes()
+
+    assert run(scenario()) == 2
+    assert sorted(row["plateNumber"] for row in history.rows.values()) == ["1", "2"]
+    assert db.write_queue.depth() == 0
+    assert [payload["plateNumber"] for _, _, payload, _ in db.write_queue.dead()] == ["bad"]
+
+def test_same_idempotency_key_is_queued_once():
+    connect(History())
+
+    async def scenario():
+        for _ in range(3):
+            await db.add_history({"type": "call", "plateNumber": "1", "ownerName": "x"}, "k1", site="s1")
+
+    run(scenario())
+    assert db.write_queue.depth() == 1
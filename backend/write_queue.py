@@ -0,0 +1,186 @@
+"""Durable local write-ahead queue for mutations that must not be lost.
+
+Writes are appended to a SQLite table (WAL mode) keyed by an idempotency
+key, so a retried request is stored once. database.py replays the queue to
+Supabase in batches and removes rows once they are confirmed upstream. Rows
+Supabase rejects outright move to dead_writes; list and requeue them with
+
+    python -m backend.write_queue dead
+    python -m backend.write_queue requeue [seq ...]
+"""
+import os
+import json
+import sqlite3
+import logging
+import threading
+from datetime import datetime
+
+try:
+    import backend.metrics as metrics
+except ImportError:
+    import metrics
+
+logger = logging.getLogger(__name__)
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+WRITE_QUEUE_PATH = os.environ.get("WRITE_QUEUE_PATH", os.path.join(BASE_DIR, "write_queue.db"))
+
+SCHEMA = """
+create table if not exists pending_writes (
+  seq integer primary key autoincrement,
+  idempotency_key text unique not null,
+  operation text not null,
+  payload text not null,
+  created_at text not null,
+  attempts integer not null default 0,
+  last_error text
+);
+create table if not exists dead_writes (
+  seq integer primary key,
+  idempotency_key text not null,
+  operation text not null,
+  payload text not null,
+  created_at text not null,
+  attempts integer not null,
+  last_error text,
+  failed_at text not null
+)
+"""
+
+class WriteQueue:
+    def __init__(self, path=WRITE_QUEUE_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("pragma journal_mode=wal")
+        # fsync at checkpoints only; a committed row survives a process crash
+        self._conn.execute("pragma synchronous=normal")
+        self._conn.executescript(SCHEMA)
+        metrics.WRITE_QUEUE_DEPTH.set(self.depth())
+
+    def enqueue(self, operation, payload, idempotency_key):
+        """Append a write. Returns (payload, created); created is False for a
+        duplicate idempotency key, in which case the original payload is returned."""
+        with self._lock:
+            try:
+                self._conn.execute(
+                    "insert into pending_writes (idempotency_key, operation, payload, created_at) values (?, ?, ?, ?)",
+                    (idempotency_key, operation, json.dumps(payload, ensure_ascii=False), datetime.now().isoformat()),
+                )
+            except sqlite3.IntegrityError:
+                row = self._conn.execute(
+                    "select payload from pending_writes where idempotency_key = ?", (idempotency_key,)
+                ).fetchone()
+                # Already flushed and removed: treat as a fresh write, replay is idempotent upstream
+                if row is None:
+                    return payload, False
+                return json.loads(row[0]), False
+        metrics.WRITE_QUEUE_DEPTH.inc()
+        return payload, True
+
+    def pending(self, limit=100, operation=None):
+        """Oldest pending writes as [(seq, operation, payload)]."""
+        query = "select seq, operation, payload from pending_writes"
+        args = ()
+        if operation:
+            query += " where operation = ?"
+            args = (operation,)
+        query += " order by seq limit ?"
+        with self._lock:
+            rows = self._conn.execute(query, args + (limit,)).fetchall()
+        return [(seq, op, json.loads(payload)) for seq, op, payload in rows]
+
+    def remove(self, seqs):
+        if not seqs:
+            return
+        with self._lock:
+            self._conn.executemany("delete from pending_writes where seq = ?", [(s,) for s in seqs])
+        metrics.WRITE_QUEUE_DEPTH.set(self.depth())
+
+    def mark_failed(self, seqs, error):
+        """Record a failed attempt; the rows stay queued."""
+        with self._lock:
+            self._conn.executemany(
+                "update pending_writes set attempts = attempts + 1, last_error = ? where seq = ?",
+                [(str(error), s) for s in seqs],
+            )
+
+    def dead_letter(self, seqs, error):
+        """Move rows that can never be written out of the queue into dead_writes.
+
+        They stop blocking the rows behind them and stay on disk for inspection
+        or requeue_dead().
+        """
+        if not seqs:
+            return
+        with self._lock:
+            self._conn.execute("begin")
+            for seq in seqs:
+                self._conn.execute(
+                    "insert or replace into dead_writes "
+                    "select seq, idempotency_key, operation, payload, created_at, attempts, ?, ? "
+                    "from pending_writes where seq = ?",
+                    (str(error), datetime.now().isoformat(), seq),
+                )
+                self._conn.execute("delete from pending_writes where seq = ?", (seq,))
+            self._conn.execute("commit")
+        metrics.WRITE_QUEUE_DEPTH.set(self.depth())
+
+    def dead(self, limit=100):
+        """Dead-lettered writes as [(seq, operation, payload, last_error)]."""
+        with self._lock:
+            rows = self._conn.execute(
+                "select seq, operation, payload, last_error from dead_writes order by seq limit ?", (limit,)
+            ).fetchall()
+        return [(seq, op, json.loads(payload), error) for seq, op, payload, error in rows]
+
+    def requeue_dead(self, seqs=None):
+        """Put dead-lettered writes back in the queue (all of them by default)."""
+        where, args = "", ()
+        if seqs is not None:
+            where = f" where seq in ({','.join('?' * len(seqs))})"
+            args = tuple(seqs)
+        with self._lock:
+            self._conn.execute("begin")
+            self._conn.execute(
+                "insert or ignore into pending_writes (idempotency_key, operation, payload, created_at) "
+                f"select idempotency_key, operation, payload, created_at from dead_writes{where} order by seq", args
+            )
+            self._conn.execute(f"delete from dead_writes{where}", args)
+            self._conn.execute("commit")
+        metrics.WRITE_QUEUE_DEPTH.set(self.depth())
+
+    def depth(self):
+        with self._lock:
+            return self._conn.execute("select count(*) from pending_writes").fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+def main(argv=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Inspect and requeue dead-lettered writes")
+    parser.add_argument("--path", default=WRITE_QUEUE_PATH)
+    sub = parser.add_subparsers(dest="command", required=True)
+    p = sub.add_parser("dead", help="List dead-lettered writes")
+    p.add_argument("--limit", type=int, default=100)
+    p = sub.add_parser("requeue", help="Move dead-lettered writes back to the queue")
+    p.add_argument("seqs", nargs="*", type=int, help="Only these (default: all)")
+    args = parser.parse_args(argv)
+
+    queue = WriteQueue(args.path)
+    try:
+        if args.command == "dead":
+            for seq, operation, payload, error in queue.dead(args.limit):
+                print(json.dumps({"seq": seq, "operation": operation, "error": error, "payload": payload},
+                                 ensure_ascii=False))
+        else:
+            queue.requeue_dead(args.seqs or None)
+            print(f"{queue.depth()} writes pending")
+    finally:
+        queue.close()
+
+if __name__ == "__main__":
+    main()